@@ -1,8 +1,8 @@
 # app.py
 import streamlit as st
 import time
-import base64
 from utils import load_css
+from asset_store import asset_srcset, asset_url
 from components.render_sidebar import render_sidebar
 
 st.set_page_config(page_title="Nutrition App", layout="wide", initial_sidebar_state="collapsed")
@@ -12,17 +12,13 @@ render_sidebar(is_admin=False)
 load_css("styles.css")
 load_css("assets/css/mobile.css")
 
-
-def load_image_base64(path):
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode()
-
 if "show_splash" not in st.session_state:
     st.session_state.show_splash = True
 
 if st.session_state.show_splash:
 
-    img_base64 = load_image_base64("assets/images/title.png")
+    title_url = asset_url("assets/images/title.png")
+    title_srcset = asset_srcset("assets/images/title.png")
 
     st.markdown(
         f"""
@@ -78,7 +74,7 @@ if st.session_state.show_splash:
         </style>
 
         <div id="splash" class="splash-bg">
-            <img src="data:image/png;base64,{img_base64}" class="splash-image" />
+            <img src="{title_url}" srcset="{title_srcset}" sizes="(max-width: 768px) 80vw, 300px" class="splash-image" />
             <div class="splash-sub">AIがあなたの健康をサポートします</div>
         </div>
 
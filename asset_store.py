@@ -0,0 +1,325 @@
+# asset_store.py
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+# -----------------------------
+# インライン HTML 用の画像・音声の base64 キャッシュ
+#   ファイルの更新時刻とサイズが変わらない限り、読み込みと変換はプロセスで1回だけ
+#   合計サイズが上限を超えたら、使われていないものから捨てる
+# -----------------------------
+MAX_CACHE_BYTES = 64 * 1024 * 1024   # base64 文字列の合計の上限
+
+_cache = OrderedDict()   # path -> (mtime_ns, size, base64 文字列)
+_cache_bytes = 0
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def load_base64(path):
+    """ファイルを base64 文字列で返す（キャッシュ済みで変更がなければ読み直さない）"""
+    global _cache_bytes
+    stat = os.stat(path)
+    with _lock:
+        entry = _cache.get(path)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            _cache.move_to_end(path)
+            _stats["hits"] += 1
+            return entry[2]
+
+    with open(path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode()
+
+    with _lock:
+        _stats["misses"] += 1
+        old = _cache.pop(path, None)
+        if old:
+            _cache_bytes -= len(old[2])
+        _cache[path] = (stat.st_mtime_ns, stat.st_size, encoded)
+        _cache_bytes += len(encoded)
+        while _cache_bytes > MAX_CACHE_BYTES and len(_cache) > 1:
+            _, (_, _, evicted) = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+            _stats["evictions"] += 1
+    return encoded
+
+
+def data_uri(path):
+    """<img src> や CSS の url() にそのまま使える data URI"""
+    mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return f"data:{mime};base64,{load_base64(path)}"
+
+
+def cache_stats():
+    """{"entries", "bytes", "hits", "misses", "evictions"}"""
+    with _lock:
+        return {"entries": len(_cache), "bytes": _cache_bytes, **_stats}
+
+
+# -----------------------------
+# 静的ファイル配信用の URL
+#   .streamlit/config.toml の server.enableStaticServing が有効なら、ファイルを
+#   内容のハッシュ付きの名前で static/assets/ にコピーし app/static/... の URL を返す
+#   （内容が変われば URL も変わるので、ブラウザは同じ URL をキャッシュし続けてよい。
+#     Streamlit は ETag / Last-Modified を返す。長期の Cache-Control を付けたい場合は
+#     前段のプロキシで /app/static/assets/ に immutable を付ける）
+#   無効なら data URI に戻す
+# -----------------------------
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+PUBLISH_DIR = "assets"   # STATIC_DIR の下のコピー先（生成物なので git 管理外）
+HASH_LENGTH = 12
+
+_urls = {}     # path -> (mtime_ns, size, url)
+_hashes = {}   # path -> (mtime_ns, size, sha256 の先頭 HASH_LENGTH 文字)
+
+
+def _static_serving_enabled():
+    try:
+        return bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        return False
+
+
+def file_hash(path):
+    """ファイル内容のハッシュ（更新時刻とサイズが同じ間は計算し直さない）"""
+    stat = os.stat(path)
+    with _lock:
+        entry = _hashes.get(path)
+    if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+        return entry[2]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    digest = h.hexdigest()[:HASH_LENGTH]
+    with _lock:
+        _hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def _tmp_path(dst):
+    return f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _publish(path):
+    """path を内容のハッシュ付きの名前でコピーし、static からの相対パスを返す"""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    name = f"{PUBLISH_DIR}/{stem}.{file_hash(path)}{ext}"
+
+    dst = os.path.join(STATIC_DIR, name)
+    if not os.path.exists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = _tmp_path(dst)
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dst)
+    return name
+
+
+def _static_url(local_path):
+    return "app/static/" + os.path.relpath(local_path, STATIC_DIR).replace(os.sep, "/")
+
+
+def static_url(local_path):
+    """static/ の下に作ったファイルの URL（静的配信が無効なら data URI）"""
+    if not _static_serving_enabled():
+        return data_uri(local_path)
+    return _static_url(local_path)
+
+
+def asset_url(path):
+    """HTML の src / url() に使う URL（静的配信が無効なら data URI）。最適化済みの版があればそちらを使う"""
+    src = optimized_path(path)
+    if not _static_serving_enabled():
+        return data_uri(src)
+    if src != path:
+        # 最適化済みの版はすでにハッシュ付きの名前で static/ の下にある
+        return _static_url(src)
+
+    stat = os.stat(path)
+    with _lock:
+        entry = _urls.get(path)
+    if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+        return entry[2]
+
+    url = f"app/static/{_publish(path)}"
+    with _lock:
+        _urls[path] = (stat.st_mtime_ns, stat.st_size, url)
+    return url
+
+
+# -----------------------------
+# サムネイル
+#   表示サイズごとの WebP を static/thumbs/ に作る（名前は 元ファイルのハッシュ + サイズ）
+#   初回に必要になったとき作るか、python asset_store.py thumbs で事前に作っておく
+#   合計が MAX_THUMB_BYTES を超えたら、最後に使われたのが古いものから消す
+# -----------------------------
+THUMB_DIR = "thumbs"     # STATIC_DIR の下（生成物なので git 管理外）
+MAX_THUMB_BYTES = 32 * 1024 * 1024
+THUMB_QUALITY = 85
+
+GRID_THUMB = 140         # キャラ図鑑の一覧
+PORTRAIT_THUMB = 240     # 育成タブのキャラ
+GACHA_THUMB = 300        # ガチャ結果
+
+TOUCH_INTERVAL_SEC = 60   # 最終利用時刻（ファイルの mtime）を更新する最小間隔
+
+_thumbs = {}    # (path, px) -> (mtime_ns, size, サムネイルのパス)
+_touched = {}   # サムネイルのパス -> 最後に mtime を更新した time.monotonic()
+
+
+def _evict_thumbs(keep):
+    files = []
+    for entry in os.scandir(os.path.join(STATIC_DIR, THUMB_DIR)):
+        if entry.is_file() and entry.path != keep:
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files) + os.path.getsize(keep)
+    for _, size, old in sorted(files):
+        if total <= MAX_THUMB_BYTES:
+            break
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+        total -= size
+    with _lock:
+        for key, (_, _, thumb) in list(_thumbs.items()):
+            if not os.path.exists(thumb):
+                del _thumbs[key]
+                _touched.pop(thumb, None)
+
+
+def _touch(thumb):
+    """LRU のため最終利用時刻を更新する（同じファイルは TOUCH_INTERVAL_SEC に1回まで）。
+    ファイルが消えていたら（他のプロセスが追い出した）False
+    """
+    now = time.monotonic()
+    with _lock:
+        if now - _touched.get(thumb, -TOUCH_INTERVAL_SEC) < TOUCH_INTERVAL_SEC:
+            return True
+        _touched[thumb] = now
+    try:
+        os.utime(thumb)
+    except FileNotFoundError:
+        with _lock:
+            _touched.pop(thumb, None)
+        return False
+    return True
+
+
+def thumbnail_path(path, px):
+    """path の画像を px 四方に収まるよう縮小した WebP のパス（拡大はしない）"""
+    stat = os.stat(path)
+    with _lock:
+        entry = _thumbs.get((path, px))
+    if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size and _touch(entry[2]):
+        return entry[2]
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    thumb = os.path.join(STATIC_DIR, THUMB_DIR, f"{stem}.{file_hash(path)}.{px}.webp")
+    if os.path.exists(thumb):
+        _touch(thumb)
+    else:
+        from PIL import Image
+
+        os.makedirs(os.path.dirname(thumb), exist_ok=True)
+        with Image.open(path) as img:
+            img = img.convert("RGBA")
+            img.thumbnail((px, px), Image.LANCZOS)
+            tmp = _tmp_path(thumb)
+            img.save(tmp, "WEBP", quality=THUMB_QUALITY)
+        os.replace(tmp, thumb)
+        _evict_thumbs(keep=thumb)
+
+    with _lock:
+        _thumbs[(path, px)] = (stat.st_mtime_ns, stat.st_size, thumb)
+    return thumb
+
+
+def thumbnail_url(path, px):
+    """HTML 用のサムネイル URL（静的配信が無効なら data URI）"""
+    return static_url(thumbnail_path(path, px))
+
+
+# -----------------------------
+# 最適化済みアセット
+#   scripts/optimize_assets.py build が static/optimized/ に作った版をマニフェストから引く
+#   元ファイルが変わっていたら（ハッシュが違えば）使わずに元ファイルに戻す
+# -----------------------------
+OPTIMIZED_DIR = "optimized"   # STATIC_DIR の下（生成物なので git 管理外）
+MANIFEST_NAME = "manifest.json"
+MOBILE_WIDTH = 768            # assets/css/mobile.css のブレークポイント
+
+_manifest = {"mtime": None, "assets": {}}
+
+
+def load_manifest():
+    """{元ファイルのパス: {"hash", "bytes", "width", "height", "best", "variants": {...}}}（なければ空）"""
+    path = os.path.join(STATIC_DIR, OPTIMIZED_DIR, MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _lock:
+        if _manifest["mtime"] == mtime:
+            return _manifest["assets"]
+    with open(path, encoding="utf-8") as f:
+        assets = json.load(f)["assets"]
+    with _lock:
+        _manifest.update(mtime=mtime, assets=assets)
+    return assets
+
+
+def optimized_path(path, variant=None):
+    """最適化済みの版のパス。variant を省略すると元より小さくなった版（png / webp）、なければ path"""
+    entry = load_manifest().get(path.replace(os.sep, "/"))
+    if not entry or entry["hash"] != file_hash(path):
+        return path
+    found = entry["variants"].get(variant or entry["best"])
+    return os.path.join(STATIC_DIR, OPTIMIZED_DIR, found["file"]) if found else path
+
+
+def asset_srcset(path):
+    """<img srcset> 用の "モバイル版 768w, 通常版 1024w"（モバイル版がなければ空文字）"""
+    entry = load_manifest().get(path.replace(os.sep, "/"))
+    mobile = optimized_path(path, "mobile")
+    if mobile == path or not _static_serving_enabled():
+        return ""
+    return f"{_static_url(mobile)} {MOBILE_WIDTH}w, {asset_url(path)} {entry['width']}w"
+
+
+# -------------------------
+# サムネイルの事前生成
+#   python asset_store.py thumbs
+# -------------------------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="画像アセットの管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_thumbs = sub.add_parser("thumbs", help="キャラ画像のサムネイルを作る")
+    p_thumbs.add_argument("--dir", default="assets/images/characters")
+
+    args = parser.parse_args()
+
+    if args.command == "thumbs":
+        count, before, after = 0, 0, 0
+        for name in sorted(os.listdir(args.dir)):
+            if not name.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
+                continue
+            src = os.path.join(args.dir, name)
+            for px in (GRID_THUMB, PORTRAIT_THUMB, GACHA_THUMB):
+                thumb = thumbnail_path(src, px)
+                before += os.path.getsize(src)
+                after += os.path.getsize(thumb)
+                count += 1
+        print(f"{count} 件のサムネイル: 元画像 {before / 1e6:.1f}MB → {after / 1e6:.1f}MB")
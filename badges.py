@@ -0,0 +1,206 @@
+# badges.py
+from datetime import date, timedelta
+
+from db import (
+    get_streak_record, load_daily_activity, get_user_profile,
+    save_badge_progress, load_badge_progress, subscribe,
+)
+from utils import calc_nutrient_targets
+
+# =========================================================
+# ⭐ 実績バッジ定義（宣言的）
+#   kind:
+#     logged    … 1回でも記録したか
+#     streak    … 食事記録の連続日数（user_streaks）
+#     day_rule  … 今日から遡って rule を満たす日が何日続いているか
+#   rule:
+#     {"category": 区分}           その区分の記録がある
+#     {"no_late": True}             夜食（22〜3時）の記録がない
+#     {"nutrient": 名前, "min": r}  目標値 × r 以上
+#     {"nutrient": 名前, "max": r}  目標値 × r 以下
+#   ※ 記録のない日は常に不成立
+# =========================================================
+BADGES = [
+    {
+        "id": "first",
+        "req": 1,
+        "title": "はじめの一歩",
+        "desc": "初めて食事を記録する",
+        "kind": "logged",
+    },
+    {
+        "id": "3days",
+        "req": 3,
+        "title": "三日坊主卒業",
+        "desc": "食事記録を3日連続で続ける",
+        "kind": "streak",
+    },
+    {
+        "id": "7days",
+        "req": 7,
+        "title": "習慣化の兆し",
+        "desc": "食事記録を7日連続で続ける",
+        "kind": "streak",
+    },
+    {
+        "id": "30days",
+        "req": 30,
+        "title": "日常茶飯事",
+        "desc": "食事記録を30日連続で続ける",
+        "kind": "streak",
+    },
+    {
+        "id": "early_morning",
+        "req": 3,
+        "title": "1日の準備",
+        "desc": "朝食を3日連続で続ける",
+        "kind": "day_rule",
+        "rule": {"category": "朝食"},
+    },
+    {
+        "id": "prohabit_late_night_snack",
+        "req": 7,
+        "title": "健康的習慣",
+        "desc": "夜食を7日間しなかった",
+        "kind": "day_rule",
+        "rule": {"no_late": True},
+    },
+    {
+        "id": "protein_king",
+        "req": 5,
+        "title": "たんぱく質王",
+        "desc": "たんぱく質の目標量を5日連続で達成",
+        "kind": "day_rule",
+        "rule": {"nutrient": "たんぱく質", "min": 1.0},
+    },
+    {
+        "id": "salt_control",
+        "req": 7,
+        "title": "減塩の達人",
+        "desc": "塩分を目標以内で7日連続キープ",
+        "kind": "day_rule",
+        "rule": {"nutrient": "塩分", "max": 1.0},
+    },
+]
+
+
+# =========================================================
+# 🔥 判定エンジン
+# =========================================================
+def load_snapshot(user_id, today=None):
+    """全バッジの判定に必要なデータを一度だけ読み込む"""
+    today = today or date.today()
+    window = max((b["req"] for b in BADGES if b["kind"] == "day_rule"), default=1)
+    start = today - timedelta(days=window - 1)
+    return {
+        "today": today,
+        "streak": get_streak_record(user_id),
+        "days": load_daily_activity(user_id, start.isoformat(), today.isoformat()),
+    }
+
+
+def _day_matches(rule, day, targets):
+    if "category" in rule:
+        return rule["category"] in day["categories"]
+    if rule.get("no_late"):
+        return not day["late"]
+    if "nutrient" in rule:
+        if not targets or not targets.get(rule["nutrient"]):
+            return False
+        value = day.get(rule["nutrient"], 0)
+        target = targets[rule["nutrient"]]
+        if "min" in rule and value < target * rule["min"]:
+            return False
+        if "max" in rule and value > target * rule["max"]:
+            return False
+        return True
+    return False
+
+
+def _day_rule_progress(badge, snapshot, targets):
+    """今日から遡って条件を満たす日が何日続いているか（req で打ち切り）"""
+    progress = 0
+    for offset in range(badge["req"]):
+        day = snapshot["days"].get((snapshot["today"] - timedelta(days=offset)).isoformat())
+        if not day or not _day_matches(badge["rule"], day, targets):
+            break
+        progress += 1
+    return progress
+
+
+def badge_progress(badge, snapshot, targets=None):
+    kind = badge["kind"]
+    if kind == "logged":
+        return 1 if snapshot["streak"]["last_date"] else 0
+    if kind == "streak":
+        return snapshot["streak"]["current"]
+    if kind == "day_rule":
+        return _day_rule_progress(badge, snapshot, targets)
+    raise ValueError(f"unknown badge kind: {kind}")
+
+
+def evaluate_badges(user_id, targets=None, kinds=None):
+    """バッジの進捗を {badge_id: 進捗} で返す（DB 読み込みは snapshot の1回分だけ）
+
+    kinds を指定した場合はその種別のバッジだけ判定する。
+    """
+    snapshot = load_snapshot(user_id)
+    return {
+        b["id"]: badge_progress(b, snapshot, targets)
+        for b in BADGES
+        if kinds is None or b["kind"] in kinds
+    }
+
+
+# =========================================================
+# 💾 進捗の保存（書き込み時にイベントで更新）
+# =========================================================
+# 種別ごとに、進捗が変わりうるイベント
+KIND_EVENTS = {
+    "logged": {"meal_saved"},
+    "streak": {"meal_saved"},
+    "day_rule": {"meal_saved"},
+}
+
+
+def _targets_for(user_id):
+    profile = get_user_profile(user_id)
+    return calc_nutrient_targets(profile) if profile else None
+
+
+def update_badge_progress(user_id, targets=None, kinds=None):
+    """進捗を判定して user_badge_progress に保存し、判定結果を返す"""
+    if targets is None:
+        targets = _targets_for(user_id)
+    progresses = evaluate_badges(user_id, targets, kinds)
+    save_badge_progress(user_id, progresses, date.today().isoformat())
+    return progresses
+
+
+def get_badge_progress(user_id, targets=None):
+    """保存済みの進捗を返す。
+
+    day_rule は「今日から遡って」数えるので、今日まだ判定していない
+    （または未保存のバッジがある）場合だけ1回判定し直す。
+    """
+    stored = load_badge_progress(user_id)
+    today = date.today().isoformat()
+    if all(b["id"] in stored and stored[b["id"]]["evaluated_on"] == today for b in BADGES):
+        return {badge_id: v["progress"] for badge_id, v in stored.items()}
+    return update_badge_progress(user_id, targets)
+
+
+def subscribe_events():
+    """KIND_EVENTS のイベントで進捗を更新するハンドラを登録する（何度呼んでもよい）
+
+    食事を保存する側（jobs.py）が起動時に呼ぶ。
+    """
+    events = set().union(*KIND_EVENTS.values())
+    for event in events:
+        kinds = {kind for kind, evs in KIND_EVENTS.items() if event in evs}
+
+        def handler(user_id, _kinds=kinds, **_):
+            update_badge_progress(user_id, kinds=_kinds)
+
+        handler.__name__ = f"update_badges_on_{event}"
+        subscribe(event, handler)
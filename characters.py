@@ -0,0 +1,259 @@
+# characters.py
+import hashlib
+import os
+import random
+import re
+import threading
+import traceback
+
+from asset_store import STATIC_DIR, file_hash, static_url
+
+CHAR_DIR = "assets/images/characters"
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# レアリティ（番号→表示ラベル）。ファイル名の starX_ の X が番号
+RARITY_LABELS = {1: "N", 2: "R", 3: "SR", 4: "UR", 5: "LEGEND"}
+DEFAULT_RARITY = 1   # 命名規則に合わないファイルは N として扱う
+
+_RARITY_PATTERN = re.compile(r"^star(\d)_")
+
+
+def rarity_of(filename):
+    """ファイル名（starX_Y.png）からレアリティ番号を取り出す"""
+    m = _RARITY_PATTERN.match(filename)
+    num = int(m.group(1)) if m else DEFAULT_RARITY
+    return num if num in RARITY_LABELS else DEFAULT_RARITY
+
+
+# -----------------------------
+# キャラ図鑑のインデックス
+#   フォルダの一覧・レアリティ・画像サイズ・内容のハッシュをまとめて1回だけ読む
+#   ガチャの抽選用にレアリティごとの一覧も持っておく
+# -----------------------------
+class CharacterCatalog:
+    def __init__(self, directory=CHAR_DIR):
+        from PIL import Image
+
+        self.directory = directory
+        self.characters = {}   # ファイル名 -> {"name", "path", "rarity", "label", "width", "height", "hash"}
+        self.pools = {num: [] for num in RARITY_LABELS}
+
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTS))
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            path = f"{directory}/{name}"
+            with Image.open(path) as img:   # ヘッダーだけ読む
+                width, height = img.size
+            num = rarity_of(name)
+            self.characters[name] = {
+                "name": name,
+                "path": path,
+                "rarity": num,
+                "label": RARITY_LABELS[num],
+                "width": width,
+                "height": height,
+                "hash": file_hash(path),
+            }
+            self.pools[num].append(name)
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.characters
+
+    def get(self, name):
+        """キャラの情報（なければ None）"""
+        return self.characters.get(name)
+
+    def path(self, name):
+        return f"{self.directory}/{name}"
+
+    def label(self, name):
+        """表示用のレアリティ（N / R / SR / UR / LEGEND）"""
+        entry = self.characters.get(name)
+        return entry["label"] if entry else RARITY_LABELS[rarity_of(name)]
+
+    def pick(self, rarity):
+        """rarity のキャラを1体選ぶ。そのレアリティがいなければ全体から（1体もいなければ None）"""
+        pool = self.pools.get(rarity) or self.names
+        return random.choice(pool) if pool else None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """キャラ図鑑のインデックス（プロセスで1回だけ構築）"""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = CharacterCatalog()
+    return _catalog
+
+
+def reload_catalog():
+    global _catalog
+    with _catalog_lock:
+        _catalog = CharacterCatalog()
+
+
+# -----------------------------
+# ガチャ演出のアニメーション
+#   マシン・卵・割れた卵・キャラを合成したフレームを (キャラ, レアリティ) ごとに1回だけ
+#   アニメーション WebP（1回だけ再生）にして static/gacha/ に保存する
+#   ガチャを引くたびに合成せず、ブラウザはこのファイルを1回取ってきて再生するだけ
+# -----------------------------
+MACHINE_PATH = "assets/images/gacha_machine.png"
+EGG_DIR = "assets/images/eggs"
+RARITY_EGG = {1: "egg_n.png", 2: "egg_r.png", 3: "egg_sr.png", 4: "egg_ur.png", 5: "egg_lr.png"}
+RARITY_BREAK = {1: "egg_break_n.png", 2: "egg_break_r.png", 3: "egg_break_sr.png", 4: "egg_break_ur.png", 5: "egg_break_lr.png"}
+
+ANIM_DIR = "gacha"       # STATIC_DIR の下（生成物なので git 管理外）
+ANIM_SIZE = 512          # 出力の幅・高さの上限
+ANIM_QUALITY = 80
+ANIM_VERSION = 1         # 演出を変えたら上げる（ファイル名が変わって作り直される）
+
+
+def _open(path, size, color):
+    from PIL import Image
+
+    try:
+        return Image.open(path).convert("RGBA")
+    except Exception:
+        # 画像がなければ単色で代用する
+        return Image.new("RGBA", size, color)
+
+
+def _frames(machine, egg, break_img, char):
+    """(フレーム, 表示する ms) を順に返す。座標はマシン画像（1024px）基準"""
+    egg = egg.resize((140, 140))
+    break_img = break_img.resize((200, 200))
+
+    # 1) 転がり
+    for x in range(-140, 100, 20):
+        frame = machine.copy()
+        egg_rot = egg.rotate((x * 5) % 360, expand=True)
+        frame.paste(egg_rot, (x, 260), egg_rot)
+        yield frame, 50
+
+    # 2) 止まる
+    frame = machine.copy()
+    frame.paste(egg, (80, 260), egg)
+    yield frame, 250
+
+    # 3) 割れる
+    frame = machine.copy()
+    frame.paste(break_img, (50, 240), break_img)
+    yield frame, 350
+
+    # 4) キャラ登場（拡大）。最後のフレームは少し長く見せ、再生後もそのまま残る
+    scales = [0.3, 0.5, 0.7, 0.85, 1.0]
+    for scale in scales:
+        frame = machine.copy()
+        resized = char.resize((max(1, int(char.width * scale)), max(1, int(char.height * scale))))
+        frame.paste(resized, (80, max(0, 200 - int(50 * scale))), resized)
+        yield frame, 250 if scale == scales[-1] else 50
+
+
+GACHA_ANIM_MS = 12 * 50 + 250 + 350 + 4 * 50 + 250   # _frames の合計（結果を出すまでの待ち時間）
+
+
+def _render_animation(dst, egg_path, break_path, char_path):
+    from PIL import Image
+
+    machine = _open(MACHINE_PATH, (480, 360), (240, 240, 240, 255))
+    egg = _open(egg_path, (140, 140), (255, 200, 200, 255))
+    break_img = _open(break_path, (200, 200), (255, 220, 220, 255))
+    char = _open(char_path, (240, 240), (200, 255, 200, 255))
+
+    frames, durations = [], []
+    for frame, ms in _frames(machine, egg, break_img, char):
+        frame.thumbnail((ANIM_SIZE, ANIM_SIZE), Image.LANCZOS)
+        frames.append(frame)
+        durations.append(ms)
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    frames[0].save(
+        tmp, "WEBP", save_all=True, append_images=frames[1:],
+        duration=durations, loop=1, quality=ANIM_QUALITY, minimize_size=True,
+    )
+    os.replace(tmp, dst)
+
+
+def gacha_animation_path(name, rarity):
+    """name のキャラが rarity の卵から出てくるアニメーション WebP のパス（なければ作る）"""
+    paths = [
+        MACHINE_PATH,
+        f"{EGG_DIR}/{RARITY_EGG[rarity]}",
+        f"{EGG_DIR}/{RARITY_BREAK[rarity]}",
+        get_catalog().path(name),
+    ]
+    # 素材のどれかが変われば名前が変わる
+    parts = [str(ANIM_VERSION)] + [file_hash(p) if os.path.exists(p) else "-" for p in paths]
+    key = hashlib.sha256("|".join(parts).encode()).hexdigest()[:12]
+
+    stem = os.path.splitext(name)[0]
+    dst = os.path.join(STATIC_DIR, ANIM_DIR, f"{stem}.r{rarity}.{key}.webp")
+    if not os.path.exists(dst):
+        _render_animation(dst, *paths[1:])
+    return dst
+
+
+def gacha_animation_url(name, rarity):
+    """HTML 用のアニメーション URL（静的配信が無効なら data URI）"""
+    return static_url(gacha_animation_path(name, rarity))
+
+
+_prebuild = None
+_prebuild_lock = threading.Lock()
+
+
+def _build_all_animations():
+    for entry in get_catalog().characters.values():
+        try:
+            gacha_animation_path(entry["name"], entry["rarity"])
+        except Exception:
+            traceback.print_exc()
+
+
+def prebuild_animations():
+    """全キャラのガチャ演出をバックグラウンドで作っておく（プロセスで1回だけ。作成済みは飛ばす）
+
+    初めて引いたキャラの合成（1件 1 秒ほど）でスクリプトスレッドを待たせないため。
+    デプロイ時に python characters.py anims で作っておけばこのスレッドはすぐ終わる。
+    """
+    global _prebuild
+    with _prebuild_lock:
+        if _prebuild is None:
+            _prebuild = threading.Thread(target=_build_all_animations, name="gacha-anims", daemon=True)
+            _prebuild.start()
+
+
+# -----------------------------
+# アニメーションの事前生成
+#   python characters.py anims
+# -----------------------------
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="キャラ画像の管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("anims", help="全キャラのガチャ演出を作る（それぞれのレアリティの卵で）")
+
+    args = parser.parse_args()
+
+    if args.command == "anims":
+        start = time.perf_counter()
+        total = 0
+        for entry in get_catalog().characters.values():
+            total += os.path.getsize(gacha_animation_path(entry["name"], entry["rarity"]))
+        print(f"{len(get_catalog())} 件のアニメーション: {total / 1e6:.1f}MB（{time.perf_counter() - start:.1f}s）")
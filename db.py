@@ -1,167 +1,496 @@
 # db.py
 import sqlite3
 import json
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
 from datetime import datetime, date
 import os
 
 DB_NAME = "nutrition.db"
 
-def get_conn():
-    return sqlite3.connect(DB_NAME, check_same_thread=False)
+# 栄養素名 → meals テーブルの数値カラム
+NUTRIENT_COLUMNS = {
+    "カロリー": "calories",
+    "たんぱく質": "protein",
+    "炭水化物": "carbs",
+    "脂質": "fat",
+    "食物繊維": "fiber",
+    "糖質": "sugar",
+    "塩分": "salt",
+}
+_NUTRIENT_SET_SQL = ", ".join(f"{col}=?" for col in NUTRIENT_COLUMNS.values())
+_NUTRIENT_SUM_SQL = ", ".join(f"COALESCE(SUM({col}), 0)" for col in NUTRIENT_COLUMNS.values())
 
-def init_db():
-    conn = get_conn()
-    c = conn.cursor()
-
-    # users
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        userid TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
+# -------------------------
+# 接続管理（プール＋トランザクション）
+# -------------------------
+POOL_SIZE = 8               # プールに保持する接続の最大数
+BUSY_TIMEOUT_MS = 5000      # ロック待ちの上限（"database is locked" 対策）
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_NAME,
+        check_same_thread=False,
+        isolation_level=None,     # BEGIN / COMMIT は transaction() で明示する
+        cached_statements=256,    # 接続ごとにプリペアドステートメントを再利用
     )
-    """)
-
-    # profiles
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS profiles (
-        user_id INTEGER UNIQUE NOT NULL,
-        name TEXT,
-        age INTEGER,
-        gender TEXT,
-        height REAL,
-        weight REAL,
-        goal TEXT,
-        activity_level INTEGER,
-        favorite_food TEXT,
-        current_chara TEXT,
-        current_title TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    );
-    """)
-
-    # meals
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS meals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def connection():
+    """プールから接続を借りる（読み取り用）。
+
+    同じスレッド内でネストした場合は外側の接続をそのまま使うので、
+    トランザクション中に別の db 関数を呼んでも同じトランザクションに乗る。
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@contextmanager
+def transaction():
+    """書き込み用トランザクション。正常終了で COMMIT、例外で ROLLBACK"""
+    with connection() as conn:
+        if conn.in_transaction:
+            # 外側のトランザクションに合流
+            yield conn
+            return
+
+        # 最初に書き込みロックを取ってロック昇格時の競合を避ける
+        conn.execute("BEGIN IMMEDIATE")
+        _local.events = []
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            _local.events = None   # ロールバックした書き込みのイベントは捨てる
+            raise
+        conn.commit()
+        events, _local.events = _local.events, None
+        for event, payload in events:
+            _dispatch(event, payload)
+
+
+# -------------------------
+# イベントフック
+#   meal_saved          (user_id, date, category)
+#   exp_added           (user_id, exp, level)
+#   node_coin_collected (user_id, map_key, node_index)
+# ハンドラは書き込みのトランザクションが COMMIT されてから呼ばれる
+# （ハンドラの失敗で元の書き込みが巻き戻らないように。失敗はログに出して次へ進む）
+# -------------------------
+_subscribers = {}
+
+
+def subscribe(event, handler):
+    """イベントにハンドラを登録。同じモジュール・同名のハンドラは置き換える（再読み込み対策）"""
+    key = (handler.__module__, handler.__name__)
+    handlers = [h for h in _subscribers.get(event, []) if (h.__module__, h.__name__) != key]
+    handlers.append(handler)
+    _subscribers[event] = handlers
+
+
+def _dispatch(event, payload):
+    for handler in _subscribers.get(event, []):
+        try:
+            handler(**payload)
+        except Exception:
+            traceback.print_exc()
+
+
+def emit(event, **payload):
+    """トランザクション中ならCOMMIT後まで遅らせ、そうでなければすぐハンドラを呼ぶ"""
+    events = getattr(_local, "events", None)
+    if events is not None:
+        events.append((event, payload))
+    else:
+        _dispatch(event, payload)
+
+def init_db():
+    with transaction() as conn:
+        c = conn.cursor()
+
+        # users
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            userid TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )
+        """)
+
+        # profiles
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id INTEGER UNIQUE NOT NULL,
+            name TEXT,
+            age INTEGER,
+            gender TEXT,
+            height REAL,
+            weight REAL,
+            goal TEXT,
+            activity_level INTEGER,
+            favorite_food TEXT,
+            current_chara TEXT,
+            current_title TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        """)
+
+        # meals
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS meals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            category TEXT,
+            food TEXT,
+            grams REAL,
+            nutrients TEXT,
+            advice TEXT,
+            time TEXT,
+            calories REAL,
+            protein REAL,
+            carbs REAL,
+            fat REAL,
+            fiber REAL,
+            sugar REAL,
+            salt REAL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+        _migrate_meal_nutrients(conn)
+
+        # --- 日別・食事区分別の栄養素集計（save_meal で増分更新） ---
+        c.execute(f"""
+        CREATE TABLE IF NOT EXISTS daily_nutrition_summary (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT NOT NULL,
+            meal_count INTEGER DEFAULT 0,
+            {", ".join(f"{col} REAL DEFAULT 0" for col in NUTRIENT_COLUMNS.values())},
+            PRIMARY KEY (user_id, date, category)
+        )
+        """)
+        # 既存の食事記録があるのに集計が空なら初回のみ作成
+        if (c.execute("SELECT 1 FROM meals LIMIT 1").fetchone()
+                and not c.execute("SELECT 1 FROM daily_nutrition_summary LIMIT 1").fetchone()):
+            rebuild_daily_nutrition_summary()
+
+        # user_badges
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_badges (
+            user_id INTEGER,
+            badge_id TEXT,
+            achieved_at TEXT,
+            PRIMARY KEY (user_id, badge_id)
+        )
+        """)
+
+        # --- user_progress: レベル・経験値を保持 ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_progress (
+            user_id INTEGER PRIMARY KEY,
+            exp INTEGER DEFAULT 0,
+            level INTEGER DEFAULT 1,
+            last_exp_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+
+        # --- 冒険マップ進行 ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_map_progress (
+            user_id INTEGER PRIMARY KEY,
+            map_pos INTEGER DEFAULT 0,
+            current_chara TEXT DEFAULT '',
+            move_count INTEGER DEFAULT 0,
+            last_move_date TEXT,
+            updated_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+
+        """)
+
+        # --- daily_advice: 日ごとの総括アドバイスとを保存 ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_advice (
+        user_id TEXT,
         date TEXT,
-        category TEXT,
-        food TEXT,
-        grams REAL,
-        nutrients TEXT,
         advice TEXT,
-        time TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    # user_badges
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_badges (
-        user_id INTEGER,
-        badge_id TEXT,
-        achieved_at TEXT,
-        PRIMARY KEY (user_id, badge_id)
-    )
-    """)
-
-    # --- user_progress: レベル・経験値を保持 ---
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_progress (
-        user_id INTEGER PRIMARY KEY,
-        exp INTEGER DEFAULT 0,
-        level INTEGER DEFAULT 1,
-        last_exp_at TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    # --- 冒険マップ進行 ---
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_map_progress (
-        user_id INTEGER PRIMARY KEY,
-        map_pos INTEGER DEFAULT 0,
-        current_chara TEXT DEFAULT '',
-        move_count INTEGER DEFAULT 0,
-        last_move_date TEXT,
-        updated_at TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, date)
+        )
+        """)
+
+            # 明日の献立保存テーブル
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS tomorrow_menu (
+            user_id INTEGER,
+            date TEXT,          -- 今日の日付（=アドバイスを元に作った日）
+            menu_text TEXT,     -- 生成した献立
+            PRIMARY KEY (user_id, date)
+        )
+        """)
+
+        # --- ガチャ用（コイン管理） ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_gacha (
+            user_id INTEGER PRIMARY KEY,
+            coins INTEGER DEFAULT 0,
+            updated_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+
+        # --- ユーザ所持キャラ ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_characters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            char_name TEXT,
+            rarity TEXT,
+            obtained_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+
+        # --- マップコイン ---
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS user_node_coins (
+            user_id INTEGER NOT NULL,
+            map_key TEXT NOT NULL,
+            node_index INTEGER NOT NULL,
+            collected_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, map_key, node_index)
+        )
+        """)
+
+        # --- ユーザ称号 ---
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS user_titles (
+            user_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            obtained_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, level),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        """)
+
+        # --- 連続記録（save_meal で O(1) 更新） ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_streaks (
+            user_id INTEGER PRIMARY KEY,
+            current_streak INTEGER DEFAULT 0,
+            longest_streak INTEGER DEFAULT 0,
+            last_date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+        # 既存ユーザの連続記録を初回のみ作成
+        for (uid,) in c.execute("""
+            SELECT DISTINCT user_id FROM meals
+            WHERE user_id NOT IN (SELECT user_id FROM user_streaks)
+        """).fetchall():
+            _rebuild_streak(conn, uid)
+
+        # --- バッジ進捗（イベントフックで書き込み時に更新） ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_badge_progress (
+            user_id INTEGER NOT NULL,
+            badge_id TEXT NOT NULL,
+            progress INTEGER DEFAULT 0,
+            evaluated_on TEXT,
+            PRIMARY KEY (user_id, badge_id)
+        )
+        """)
+
+        # --- AI 栄養解析キャッシュ（食品名・モデル・プロンプト版ごとの100gあたり値） ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS nutrition_cache (
+            cache_key TEXT PRIMARY KEY,
+            food TEXT,
+            model TEXT,
+            prompt_version INTEGER,
+            nutrients TEXT,
+            created_at REAL,
+            last_used_at REAL,
+            hits INTEGER DEFAULT 0
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_nutrition_cache_last_used ON nutrition_cache (last_used_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_nutrition_cache_created ON nutrition_cache (created_at)")
+
+        # --- 食品成分表（100gあたり。foods.py の import コマンドで取り込み） ---
+        c.execute(f"""
+        CREATE TABLE IF NOT EXISTS food_composition (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            reading TEXT,
+            {", ".join(f"{col} REAL" for col in NUTRIENT_COLUMNS.values())}
+        )
+        """)
+
+        # --- バックグラウンドジョブ（jobs.py） ---
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,       -- queued / running / done / error
+            payload TEXT,
+            result TEXT,
+            error TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated_at)")
+
+        # --- インデックス（db.py の各アクセスパス用。check_query_plans で確認） ---
+        # load_meals(user_id[, date]) / load_meals_by_category / 連続日数
+        c.execute("CREATE INDEX IF NOT EXISTS idx_meals_user_date_time ON meals (user_id, date, time)")
+        # load_meals(user_id, date, category)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_meals_user_date_category_time ON meals (user_id, date, category, time)")
+        # load_user_characters（カバリングインデックス）
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_characters_user_obtained ON user_characters (user_id, obtained_at, char_name, rarity)")
+
+
+def nutrient_values(nutrients_json):
+    """nutrients の JSON（[{name, value, unit}, ...]）を {カラム名: 数値} に変換"""
+    values = {col: 0.0 for col in NUTRIENT_COLUMNS.values()}
+    try:
+        items = json.loads(nutrients_json) if isinstance(nutrients_json, str) else nutrients_json
+    except (TypeError, ValueError):
+        return values
+
+    for item in items or []:
+        col = NUTRIENT_COLUMNS.get(item.get("name"))
+        if col is None:
+            continue
+        try:
+            values[col] += float(item.get("value", 0))
+        except (TypeError, ValueError):
+            pass
+    return values
+
+
+def _migrate_meal_nutrients(conn):
+    """旧データ（nutrients の JSON のみ）に数値カラムを追加して値を埋める"""
+    existing = {r[1] for r in conn.execute("PRAGMA table_info(meals)")}
+    for col in NUTRIENT_COLUMNS.values():
+        if col not in existing:
+            conn.execute(f"ALTER TABLE meals ADD COLUMN {col} REAL")
+
+    rows = conn.execute("SELECT id, nutrients FROM meals WHERE calories IS NULL").fetchall()
+    for meal_id, nutrients_json in rows:
+        values = nutrient_values(nutrients_json)
+        conn.execute(
+            f"UPDATE meals SET {_NUTRIENT_SET_SQL} WHERE id=?",
+            (*values.values(), meal_id)
+        )
+
+def _rebuild_streak(conn, user_id):
+    """食事記録の日付一覧から連続記録を作り直す（初回移行・過去日付の記録時のみ）"""
+    dates = [
+        date.fromisoformat(r[0])
+        for r in conn.execute(
+            "SELECT DISTINCT date FROM meals WHERE user_id=? ORDER BY date", (user_id,)
+        )
+    ]
+    current = longest = 0
+    for i, d in enumerate(dates):
+        if i > 0 and (d - dates[i-1]).days == 1:
+            current += 1
+        else:
+            current = 1
+        longest = max(longest, current)
 
-    """)
+    conn.execute("""
+        INSERT INTO user_streaks (user_id, current_streak, longest_streak, last_date)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            current_streak=excluded.current_streak,
+            longest_streak=excluded.longest_streak,
+            last_date=excluded.last_date
+    """, (user_id, current, longest, dates[-1].isoformat() if dates else None))
 
-    # --- daily_advice: 日ごとの総括アドバイスとを保存 ---
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS daily_advice (
-    user_id TEXT,
-    date TEXT,
-    advice TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY (user_id, date)
-    )
-    """)
-
-        # 明日の献立保存テーブル
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS tomorrow_menu (
-        user_id INTEGER,
-        date TEXT,          -- 今日の日付（=アドバイスを元に作った日）
-        menu_text TEXT,     -- 生成した献立
-        PRIMARY KEY (user_id, date)
-    )
-    """)
-
-    # --- ガチャ用（コイン管理） ---
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_gacha (
-        user_id INTEGER PRIMARY KEY,
-        coins INTEGER DEFAULT 0,
-        updated_at TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    # --- ユーザ所持キャラ ---
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_characters (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        char_name TEXT,
-        rarity TEXT,
-        obtained_at TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    # --- マップコイン ---
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_node_coins (
-        user_id INTEGER NOT NULL,
-        map_key TEXT NOT NULL,
-        node_index INTEGER NOT NULL,
-        collected_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        PRIMARY KEY (user_id, map_key, node_index)
-    )
-    """)
-
-    # --- ユーザ称号 ---
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_titles (
-        user_id INTEGER NOT NULL,
-        level INTEGER NOT NULL,
-        title TEXT NOT NULL,
-        obtained_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        PRIMARY KEY (user_id, level),
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    """)
 
+def _update_streak(conn, user_id, date_str):
+    """記録日 date_str を連続記録に反映する"""
+    row = conn.execute(
+        "SELECT current_streak, longest_streak, last_date FROM user_streaks WHERE user_id=?",
+        (user_id,)
+    ).fetchone()
+    if row is None or row[2] is None:
+        _rebuild_streak(conn, user_id)
+        return
+
+    current, longest, last_date = row
+    if date_str == last_date:
+        return
+
+    gap = (date.fromisoformat(date_str) - date.fromisoformat(last_date)).days
+    if gap < 0:
+        # 過去の日付を後から記録した場合だけ履歴から再計算
+        _rebuild_streak(conn, user_id)
+        return
+
+    current = current + 1 if gap == 1 else 1
+    conn.execute("""
+        UPDATE user_streaks
+        SET current_streak=?, longest_streak=?, last_date=?
+        WHERE user_id=?
+    """, (current, max(longest, current), date_str, user_id))
 
 
+def rebuild_daily_nutrition_summary(user_id=None):
+    """meals から daily_nutrition_summary を作り直す（user_id 省略時は全ユーザ）"""
+    cols = ", ".join(NUTRIENT_COLUMNS.values())
+    where = "" if user_id is None else "WHERE user_id=?"
+    params = () if user_id is None else (user_id,)
 
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"DELETE FROM daily_nutrition_summary {where}", params)
+        conn.execute(f"""
+            INSERT INTO daily_nutrition_summary (user_id, date, category, meal_count, {cols})
+            SELECT user_id, date, category, COUNT(*), {_NUTRIENT_SUM_SQL}
+            FROM meals
+            {where}
+            GROUP BY user_id, date, category
+        """, params)
 
 # 初期化を自動実行
 init_db()
@@ -170,62 +499,48 @@ init_db()
 # ユーザ管理
 # -------------------------
 def create_user(userid, password):
-    conn = get_conn()
-    c = conn.cursor()
     try:
-        c.execute("INSERT INTO users (userid, password) VALUES (?, ?)", (userid, password))
-        conn.commit()
+        with transaction() as conn:
+            c = conn.execute("INSERT INTO users (userid, password) VALUES (?, ?)", (userid, password))
 
-        # 直前に挿入した行の PRIMARY KEY を返す
-        user_pk = c.lastrowid
+            # 直前に挿入した行の PRIMARY KEY を返す
+            user_pk = c.lastrowid
         return user_pk
 
     except Exception:
         return None
 
-    finally:
-        conn.close()
-
 def login(userid, password):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE userid=? AND password=?", (userid, password))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT id FROM users WHERE userid=? AND password=?", (userid, password)).fetchone()
     return row[0] if row else None
 
 # -------------------------------
 # プロフィール保存 / 取得
 # -------------------------------
 def save_user_profile(user_id, profile):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO profiles (user_id, name, age, gender, height, weight, goal, activity_level, favorite_food)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(user_id) DO UPDATE SET
-        name=excluded.name,
-        age=excluded.age,
-        gender=excluded.gender,
-        height=excluded.height,
-        weight=excluded.weight,
-        goal=excluded.goal,
-        activity_level=excluded.activity_level,
-        favorite_food=excluded.favorite_food
-    """, (
-        user_id, profile["name"], profile["age"], profile["gender"],
-        profile["height"], profile["weight"], profile["goal"],
-        profile["activity_level"], profile["favorite_food"]
-    ))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+        INSERT INTO profiles (user_id, name, age, gender, height, weight, goal, activity_level, favorite_food)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            name=excluded.name,
+            age=excluded.age,
+            gender=excluded.gender,
+            height=excluded.height,
+            weight=excluded.weight,
+            goal=excluded.goal,
+            activity_level=excluded.activity_level,
+            favorite_food=excluded.favorite_food
+        """, (
+            user_id, profile["name"], profile["age"], profile["gender"],
+            profile["height"], profile["weight"], profile["goal"],
+            profile["activity_level"], profile["favorite_food"]
+        ))
 
 def get_user_profile(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, name, age, gender, height, weight, goal, activity_level, favorite_food FROM profiles WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT user_id, name, age, gender, height, weight, goal, activity_level, favorite_food FROM profiles WHERE user_id=?", (user_id,)).fetchone()
     if not row:
         return None
     return {
@@ -241,30 +556,37 @@ def get_user_profile(user_id):
     }
 
 def load_username(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT name FROM profiles WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT name FROM profiles WHERE user_id=?", (user_id,)).fetchone()
     return row[0] if row and row[0] else "名無し"
 
 # -------------------------
 # 食事記録
 # -------------------------
 def save_meal(user_id, date, category, food, grams, nutrients_json, advice):
-    conn = get_conn()
-    c = conn.cursor()
     time_str = datetime.now().strftime("%H:%M:%S")
-    c.execute("""
-        INSERT INTO meals (user_id, date, category, food, grams, nutrients, advice, time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, date, category, food, grams, nutrients_json, advice, time_str))
-    conn.commit()
-    conn.close()
+    values = nutrient_values(nutrients_json)
+    cols = ", ".join(values.keys())
+    placeholders = ", ".join("?" * len(values))
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO meals (user_id, date, category, food, grams, nutrients, advice, time, {cols})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, {placeholders})
+        """, (user_id, date, category, food, grams, nutrients_json, advice, time_str, *values.values()))
+
+        # 日別集計を同じトランザクションで加算
+        conn.execute(f"""
+            INSERT INTO daily_nutrition_summary (user_id, date, category, meal_count, {cols})
+            VALUES (?, ?, ?, 1, {placeholders})
+            ON CONFLICT(user_id, date, category) DO UPDATE SET
+                meal_count = meal_count + 1,
+                {", ".join(f"{col} = {col} + excluded.{col}" for col in values)}
+        """, (user_id, date, category, *values.values()))
+
+        _update_streak(conn, user_id, date)
+        emit("meal_saved", user_id=user_id, date=date, category=category)
 
 def load_meals(user_id, date=None, category=None):
-    conn = get_conn()
-    c = conn.cursor()
     query = "SELECT date, category, food, grams, nutrients, advice, time FROM meals WHERE user_id=?"
     params = [user_id]
     if date is not None:
@@ -274,8 +596,8 @@ def load_meals(user_id, date=None, category=None):
         query += " AND category=?"
         params.append(category)
     query += " ORDER BY date DESC, time DESC"
-    rows = c.execute(query, tuple(params)).fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute(query, tuple(params)).fetchall()
     return [
         {
             "date": r[0],
@@ -289,79 +611,247 @@ def load_meals(user_id, date=None, category=None):
         for r in rows
     ]
 
+def load_meals_by_category(user_id, date):
+    """1日分の食事を1クエリで取得し {区分: [食事, ...]} にまとめて返す。
+
+    nutrients は数値カラムから作った {栄養素名: 値} の dict（JSON のパース不要）。
+    """
+    cols = ", ".join(NUTRIENT_COLUMNS.values())
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT category, food, grams, advice, time, {cols} FROM meals
+            WHERE user_id=? AND date=?
+            ORDER BY time DESC
+        """, (user_id, date)).fetchall()
+
+    grouped = {}
+    for r in rows:
+        grouped.setdefault(r[0], []).append({
+            "date": date,
+            "category": r[0],
+            "food": r[1],
+            "grams": r[2],
+            "nutrients": dict(zip(NUTRIENT_COLUMNS.keys(), r[5:])),
+            "advice": r[3],
+            "time": r[4],
+        })
+    return grouped
+
+def load_daily_activity(user_id, start_date, end_date):
+    """期間内の日ごとの記録状況を1クエリで返す（バッジ判定用）。
+
+    {日付: {"meals": 件数, "categories": {区分, ...}, "late": 夜食(22〜3時)の有無, 栄養素名: 合計, ...}}
+    """
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT date, COUNT(*), GROUP_CONCAT(category),
+                   MAX(CAST(substr(time, 1, 2) AS INTEGER) >= 22
+                       OR CAST(substr(time, 1, 2) AS INTEGER) < 3),
+                   {_NUTRIENT_SUM_SQL}
+            FROM meals
+            WHERE user_id=? AND date BETWEEN ? AND ?
+            GROUP BY date
+        """, (user_id, start_date, end_date)).fetchall()
+
+    activity = {}
+    for r in rows:
+        activity[r[0]] = {
+            "meals": r[1],
+            "categories": set((r[2] or "").split(",")),
+            "late": bool(r[3]),
+            **dict(zip(NUTRIENT_COLUMNS.keys(), r[4:])),
+        }
+    return activity
+
+def load_nutrient_totals(user_id, start_date, end_date=None):
+    """期間内（両端含む）の栄養素合計を {栄養素名: 合計} で返す。end_date 省略時は1日分"""
+    with connection() as conn:
+        row = conn.execute(f"""
+            SELECT {_NUTRIENT_SUM_SQL} FROM daily_nutrition_summary
+            WHERE user_id=? AND date BETWEEN ? AND ?
+        """, (user_id, start_date, end_date or start_date)).fetchone()
+    return dict(zip(NUTRIENT_COLUMNS.keys(), row))
+
+def load_daily_nutrient_totals(user_id, start_date, end_date):
+    """日ごとの栄養素合計を {日付: {栄養素名: 合計}} で返す"""
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT date, {_NUTRIENT_SUM_SQL} FROM daily_nutrition_summary
+            WHERE user_id=? AND date BETWEEN ? AND ?
+            GROUP BY date
+            ORDER BY date
+        """, (user_id, start_date, end_date)).fetchall()
+    return {r[0]: dict(zip(NUTRIENT_COLUMNS.keys(), r[1:])) for r in rows}
+
+# -------------------------
+# AI 栄養解析キャッシュ
+# -------------------------
+NUTRITION_CACHE_TTL_SEC = 30 * 24 * 3600   # 30日で期限切れ
+NUTRITION_CACHE_MAX_ENTRIES = 5000          # 超えたら最終利用が古い順に削除
+
+def get_cached_nutrients(cache_keys):
+    """キャッシュ済みの100gあたり栄養素を {cache_key: [{name, value, unit}, ...]} で返す"""
+    if not cache_keys:
+        return {}
+    now = time.time()
+    keys = list(dict.fromkeys(cache_keys))
+    placeholders = ", ".join("?" * len(keys))
+    with transaction() as conn:
+        rows = conn.execute(f"""
+            SELECT cache_key, nutrients FROM nutrition_cache
+            WHERE cache_key IN ({placeholders}) AND created_at >= ?
+        """, (*keys, now - NUTRITION_CACHE_TTL_SEC)).fetchall()
+        conn.executemany(
+            "UPDATE nutrition_cache SET last_used_at=?, hits=hits+1 WHERE cache_key=?",
+            [(now, r[0]) for r in rows]
+        )
+    return {r[0]: json.loads(r[1]) for r in rows}
+
+def put_cached_nutrients(entries):
+    """entries: [(cache_key, food, model, prompt_version, 100gあたり栄養素), ...]"""
+    if not entries:
+        return
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT INTO nutrition_cache
+                (cache_key, food, model, prompt_version, nutrients, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET
+                nutrients=excluded.nutrients,
+                created_at=excluded.created_at,
+                last_used_at=excluded.last_used_at
+        """, [
+            (key, food, model, version, json.dumps(nutrients, ensure_ascii=False), now, now)
+            for key, food, model, version, nutrients in entries
+        ])
+
+        # 期限切れ → 件数超過分（LRU）の順に削除
+        conn.execute("DELETE FROM nutrition_cache WHERE created_at < ?", (now - NUTRITION_CACHE_TTL_SEC,))
+        over = conn.execute("SELECT COUNT(*) FROM nutrition_cache").fetchone()[0] - NUTRITION_CACHE_MAX_ENTRIES
+        if over > 0:
+            conn.execute("""
+                DELETE FROM nutrition_cache WHERE cache_key IN (
+                    SELECT cache_key FROM nutrition_cache ORDER BY last_used_at LIMIT ?
+                )
+            """, (over,))
+
+# -------------------------
+# 食品成分表
+# -------------------------
+def replace_food_composition(foods):
+    """成分表を入れ替える。foods: [{"name", "reading", 栄養素名: 100gあたり値, ...}, ...]"""
+    cols = ", ".join(NUTRIENT_COLUMNS.values())
+    placeholders = ", ".join("?" * len(NUTRIENT_COLUMNS))
+    with transaction() as conn:
+        conn.execute("DELETE FROM food_composition")
+        conn.executemany(f"""
+            INSERT INTO food_composition (name, reading, {cols})
+            VALUES (?, ?, {placeholders})
+        """, [
+            (f["name"], f.get("reading"), *(f.get(name, 0) for name in NUTRIENT_COLUMNS))
+            for f in foods
+        ])
+
+def load_food_composition():
+    """成分表を全件返す（foods.py のメモリ上インデックス構築用）"""
+    cols = ", ".join(NUTRIENT_COLUMNS.values())
+    with connection() as conn:
+        rows = conn.execute(f"SELECT name, reading, {cols} FROM food_composition ORDER BY id").fetchall()
+    return [
+        {"name": r[0], "reading": r[1], **dict(zip(NUTRIENT_COLUMNS.keys(), r[2:]))}
+        for r in rows
+    ]
+
+# -------------------------
+# バックグラウンドジョブ
+# -------------------------
+def create_job(job_id, user_id, kind, payload):
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO jobs (id, user_id, kind, status, payload)
+            VALUES (?, ?, ?, 'queued', ?)
+        """, (job_id, user_id, kind, json.dumps(payload, ensure_ascii=False)))
+
+def update_job(job_id, status, result=None, error=None):
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE jobs SET status=?, result=?, error=?, updated_at=datetime('now')
+            WHERE id=?
+        """, (status, None if result is None else json.dumps(result, ensure_ascii=False), error, job_id))
+
+def get_job(job_id):
+    """ジョブの状態 {"id", "kind", "status", "result", "error"}（なければ None）"""
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT id, kind, status, result, error FROM jobs WHERE id=?", (job_id,)
+        ).fetchone()
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "kind": row[1],
+        "status": row[2],
+        "result": json.loads(row[3]) if row[3] else None,
+        "error": row[4],
+    }
+
+def abort_unfinished_jobs(message):
+    """前回のプロセスで終わらなかったジョブをエラー扱いにする（起動時用）"""
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE jobs SET status='error', error=?, updated_at=datetime('now')
+            WHERE status IN ('queued', 'running')
+        """, (message,))
+
+def purge_jobs(days=7):
+    with transaction() as conn:
+        conn.execute("DELETE FROM jobs WHERE updated_at < datetime('now', ?)", (f"-{int(days)} days",))
+
 # -------------------------
 # 日次レポート保存 / 取得
 # -------------------------
 def save_daily_advice(user_id: str, date_str: str, advice: str):
     """日付ごとのアドバイスをSQLiteに保存（上書き）"""
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS daily_advice (
-            user_id TEXT,
-            date TEXT,
-            advice TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(user_id, date)
-        )
-    """)
-    cur.execute("""
-        INSERT INTO daily_advice (user_id, date, advice)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id, date) DO UPDATE SET advice=excluded.advice
-    """, (user_id, date_str, advice))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO daily_advice (user_id, date, advice)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, date) DO UPDATE SET advice=excluded.advice
+        """, (user_id, date_str, advice))
 
 
 def load_daily_advice(user_id: str, date_str: str):
     """指定した日付のアドバイスを取得（なければ None）"""
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT advice FROM daily_advice
-        WHERE user_id = ? AND date = ?
-    """, (user_id, date_str))
-    row = cur.fetchone()
-    conn.close()
-    
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT advice FROM daily_advice
+            WHERE user_id = ? AND date = ?
+        """, (user_id, date_str)).fetchone()
+
     if row:
         return row[0]
     return None
 
 def get_daily_advice(user_id, date_str):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT advice FROM daily_advice
-        WHERE user_id = ? AND date = ?
-    """, (user_id, date_str))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return load_daily_advice(user_id, date_str)
 
 # -------------------------
 # 明日の献立保存 / 取得
 # -------------------------
 def save_tomorrow_menu(user_id: int, date_str: str, menu_text: str):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        INSERT OR REPLACE INTO tomorrow_menu (user_id, date, menu_text)
-        VALUES (?, ?, ?)
-    """, (user_id, date_str, menu_text))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO tomorrow_menu (user_id, date, menu_text)
+            VALUES (?, ?, ?)
+        """, (user_id, date_str, menu_text))
 
 def get_tomorrow_menu(user_id: int, date_str: str):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT menu_text FROM tomorrow_menu
-        WHERE user_id = ? AND date = ?
-    """, (user_id, date_str))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT menu_text FROM tomorrow_menu
+            WHERE user_id = ? AND date = ?
+        """, (user_id, date_str)).fetchone()
     return row[0] if row else None
 
 
@@ -369,23 +859,37 @@ def get_tomorrow_menu(user_id: int, date_str: str):
 # バッジ保存・取得
 # -------------------------
 def save_user_badge(user_id, badge_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "INSERT OR IGNORE INTO user_badges (user_id, badge_id, achieved_at) VALUES (?, ?, datetime('now'))",
-        (user_id, badge_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO user_badges (user_id, badge_id, achieved_at) VALUES (?, ?, datetime('now'))",
+            (user_id, badge_id)
+        )
 
 def load_user_badges(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT badge_id FROM user_badges WHERE user_id=?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute("SELECT badge_id FROM user_badges WHERE user_id=?", (user_id,)).fetchall()
     return {r[0] for r in rows}
 
+def save_badge_progress(user_id, progresses, evaluated_on):
+    """バッジ進捗 {badge_id: 進捗} をまとめて保存"""
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT INTO user_badge_progress (user_id, badge_id, progress, evaluated_on)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, badge_id) DO UPDATE SET
+                progress=excluded.progress,
+                evaluated_on=excluded.evaluated_on
+        """, [(user_id, badge_id, p, evaluated_on) for badge_id, p in progresses.items()])
+
+def load_badge_progress(user_id):
+    """保存済みのバッジ進捗 {badge_id: {"progress": 進捗, "evaluated_on": 判定日}}"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT badge_id, progress, evaluated_on FROM user_badge_progress WHERE user_id=?",
+            (user_id,)
+        ).fetchall()
+    return {r[0]: {"progress": r[1], "evaluated_on": r[2]} for r in rows}
+
 # -------------------------
 # 進捗（経験値/レベル）操作
 # -------------------------
@@ -420,57 +924,52 @@ TITLE_BY_LEVEL = {
 
 
 def get_progress(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT exp, level FROM user_progress WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT exp, level FROM user_progress WHERE user_id=?", (user_id,)).fetchone()
     if not row:
         return {"exp": 0, "level": 1}
     return {"exp": row[0], "level": row[1]}
 
 def add_exp(user_id, exp_gain):
-    conn = get_conn()
-    c = conn.cursor()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT exp, level FROM user_progress WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
+
+        if row is None:
+            exp = exp_gain
+            level = 1
+            conn.execute(
+                "INSERT INTO user_progress (user_id, exp, level, last_exp_at) VALUES (?, ?, ?, datetime('now'))",
+                (user_id, exp, level)
+            )
+        else:
+            exp, level = row
+            exp += exp_gain
 
-    c.execute(
-        "SELECT exp, level FROM user_progress WHERE user_id=?",
-        (user_id,)
-    )
-    row = c.fetchone()
-
-    if row is None:
-        exp = exp_gain
-        level = 1
-        c.execute(
-            "INSERT INTO user_progress (user_id, exp, level, last_exp_at) VALUES (?, ?, ?, datetime('now'))",
-            (user_id, exp, level)
-        )
-    else:
-        exp, level = row
-        exp += exp_gain
+            new_level = level
+            for lv in sorted(LEVEL_EXP.keys()):
+                if exp >= LEVEL_EXP[lv]:
+                    new_level = lv
 
-        new_level = level
-        for lv in sorted(LEVEL_EXP.keys()):
-            if exp >= LEVEL_EXP[lv]:
-                new_level = lv
+            if new_level > MAX_LEVEL:
+                new_level = MAX_LEVEL
 
-        if new_level > MAX_LEVEL:
-            new_level = MAX_LEVEL
+            # 称号付与も同じトランザクション内で行う
+            if new_level > level:
+                for lv in range(level + 1, new_level + 1):
+                    grant_title_if_needed(user_id, lv)
 
-        if new_level > level:
-            for lv in range(level + 1, new_level + 1):
-                grant_title_if_needed(user_id, lv)
+            level = new_level
 
-        level = new_level
+            conn.execute(
+                "UPDATE user_progress SET exp=?, level=?, last_exp_at=datetime('now') WHERE user_id=?",
+                (exp, level, user_id)
+            )
 
-        c.execute(
-            "UPDATE user_progress SET exp=?, level=?, last_exp_at=datetime('now') WHERE user_id=?",
-            (exp, level, user_id)
-        )
+        emit("exp_added", user_id=user_id, exp=exp, level=level)
 
-    conn.commit()
-    conn.close()
     return get_progress(user_id)
 
 
@@ -480,48 +979,53 @@ def grant_title_if_needed(user_id, level):
 
     title = TITLE_BY_LEVEL[level]
 
-    conn = get_conn()
-    c = conn.cursor()
+    with transaction() as conn:
+        # すでに持っているか？
+        exists = conn.execute(
+            "SELECT 1 FROM user_titles WHERE user_id=? AND title=?",
+            (user_id, title)
+        ).fetchone()
+
+        if not exists:
+            # 追加
+            conn.execute(
+                "INSERT INTO user_titles (user_id, title, level) VALUES (?, ?, ?)",
+                (user_id, title, level)
+            )
 
-    # すでに持っているか？
-    c.execute(
-        "SELECT 1 FROM user_titles WHERE user_id=? AND title=?",
-        (user_id, title)
-    )
-    exists = c.fetchone()
+            # 初回称号なら自動セット
+            row = conn.execute(
+                "SELECT current_title FROM profiles WHERE user_id=?",
+                (user_id,)
+            ).fetchone()
+            if not row or not row[0]:
+                conn.execute(
+                    "UPDATE profiles SET current_title=? WHERE user_id=?",
+                    (title, user_id)
+                )
 
-    if not exists:
-        # 追加
-        c.execute(
-            "INSERT INTO user_titles (user_id, title, level) VALUES (?, ?, ?)",
-            (user_id, title, level)
-        )
+def get_user_titles(user_id):
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT title FROM user_titles WHERE user_id=? ORDER BY level",
+            (user_id,)
+        ).fetchall()
+    return [r[0] for r in rows]
 
-        # 初回称号なら自動セット
-        c.execute(
+def get_current_title(user_id):
+    with connection() as conn:
+        row = conn.execute(
             "SELECT current_title FROM profiles WHERE user_id=?",
             (user_id,)
+        ).fetchone()
+    return row[0] if row and row[0] else "無名"
+
+def set_current_title(user_id, title):
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE profiles SET current_title=? WHERE user_id=?",
+            (title, user_id)
         )
-        row = c.fetchone()
-        if not row or not row[0]:
-            c.execute(
-                "UPDATE profiles SET current_title=? WHERE user_id=?",
-                (title, user_id)
-            )
-
-    conn.commit()
-    conn.close()
-
-def get_user_titles(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT title FROM user_titles WHERE user_id=? ORDER BY level",
-        (user_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
 
 
 
@@ -529,34 +1033,38 @@ def get_user_titles(user_id):
 # -------------------------
 # ヘルパー：連続日数取得
 # -------------------------
+def get_streak_record(user_id):
+    """連続記録 {"current": 最新記録日までの連続日数, "longest": 最長, "last_date": 最終記録日}"""
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT current_streak, longest_streak, last_date FROM user_streaks WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
+    if not row:
+        return {"current": 0, "longest": 0, "last_date": None}
+    return {"current": row[0], "longest": row[1], "last_date": row[2]}
+
 def get_consecutive_days(user_id):
-    """ユーザが何日連続で記録しているか（今日含む）"""
-    meals = load_meals(user_id)
-    dates = sorted({m["date"] for m in meals}, reverse=True)
-    if not dates:
-        return 0
-    streak = 1
-    for i in range(1, len(dates)):
-        d1 = datetime.fromisoformat(dates[i-1]).date()
-        d2 = datetime.fromisoformat(dates[i]).date()
-        if (d1 - d2).days == 1:
-            streak += 1
-        else:
-            break
-    return streak
+    """ユーザが何日連続で記録しているか（最新の記録日を含む）"""
+    return get_streak_record(user_id)["current"]
 
 # -------------------------
 # 冒険マップ進行
 # -------------------------
+def ensure_map_progress(user_id):
+    with transaction() as conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO user_map_progress (
+                user_id, map_pos, current_chara, move_count, updated_at
+            ) VALUES (?, 0, '', 0, ?)
+        """, (user_id, datetime.now().isoformat()))
+
 def get_map_progress(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT map_pos, current_chara FROM user_map_progress WHERE user_id=?",
-        (user_id,)
-    )
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT map_pos, current_chara FROM user_map_progress WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
 
     if row:
         return {
@@ -572,192 +1080,150 @@ def get_map_progress(user_id):
 
 
 def save_map_progress(user_id, map_pos, current_chara):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO user_map_progress (user_id, map_pos, current_chara, updated_at)
-        VALUES (?, ?, ?, datetime('now'))
-        ON CONFLICT(user_id) DO UPDATE SET
-            map_pos=excluded.map_pos,
-            current_chara=excluded.current_chara,
-            updated_at=datetime('now')
-    """, (user_id, map_pos, current_chara))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO user_map_progress (user_id, map_pos, current_chara, updated_at)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT(user_id) DO UPDATE SET
+                map_pos=excluded.map_pos,
+                current_chara=excluded.current_chara,
+                updated_at=datetime('now')
+        """, (user_id, map_pos, current_chara))
 
 def get_move_count(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT move_count
-        FROM user_map_progress
-        WHERE user_id = ?
-    """, (user_id,))
-
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT move_count
+            FROM user_map_progress
+            WHERE user_id = ?
+        """, (user_id,)).fetchone()
 
     return row[0] if row else 0
 
 def add_move_count(user_id, n):
     today = date.today().isoformat()
 
-    conn = get_conn()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT last_move_date
-        FROM user_map_progress
-        WHERE user_id = ?
-    """, (user_id,))
-    row = c.fetchone()
-
-    # 今日すでに付与済みなら何もしない
-    if row and row[0] == today:
-        conn.close()
-        return False
-
-    # move_count 加算 & 日付更新
-    c.execute("""
-        UPDATE user_map_progress
-        SET move_count = move_count + ?,
-            last_move_date = ?,
-            updated_at = ?
-        WHERE user_id = ?
-    """, (
-        n,
-        today,
-        today,
-        user_id
-    ))
-
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        row = conn.execute("""
+            SELECT last_move_date
+            FROM user_map_progress
+            WHERE user_id = ?
+        """, (user_id,)).fetchone()
+
+        # 今日すでに付与済みなら何もしない
+        if row and row[0] == today:
+            return False
+
+        # move_count 加算 & 日付更新
+        conn.execute("""
+            UPDATE user_map_progress
+            SET move_count = move_count + ?,
+                last_move_date = ?,
+                updated_at = ?
+            WHERE user_id = ?
+        """, (
+            n,
+            today,
+            today,
+            user_id
+        ))
+
     return True
 
 def consume_move_count(user_id, n):
-    conn = get_conn()
-    c = conn.cursor()
-
-    c.execute("""
-        UPDATE user_map_progress
-        SET move_count = MAX(move_count - ?, 0),
-            updated_at = ?
-        WHERE user_id = ?
-    """, (
-        n,
-        datetime.now().isoformat(),
-        user_id
-    ))
-
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE user_map_progress
+            SET move_count = MAX(move_count - ?, 0),
+                updated_at = ?
+            WHERE user_id = ?
+        """, (
+            n,
+            datetime.now().isoformat(),
+            user_id
+        ))
 
 
 # -------------------------
 # ガチャコイン管理
 # -------------------------
 def get_gacha_coins(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT coins FROM user_gacha WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT coins FROM user_gacha WHERE user_id=?", (user_id,)).fetchone()
     return row[0] if row else 0
 
 
 def add_gacha_coins(user_id, amount):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO user_gacha (user_id, coins, updated_at)
-        VALUES (?, ?, datetime('now'))
-        ON CONFLICT(user_id) DO UPDATE SET
-            coins = coins + excluded.coins,
-            updated_at = datetime('now')
-    """, (user_id, amount))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO user_gacha (user_id, coins, updated_at)
+            VALUES (?, ?, datetime('now'))
+            ON CONFLICT(user_id) DO UPDATE SET
+                coins = coins + excluded.coins,
+                updated_at = datetime('now')
+        """, (user_id, amount))
 
 
 def consume_gacha_coin(user_id, amount=1):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT coins FROM user_gacha WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-
-    if not row or row[0] < amount:
-        conn.close()
-        return False
-
-    c.execute("""
-        UPDATE user_gacha
-        SET coins = coins - ?, updated_at=datetime('now')
-        WHERE user_id=?
-    """, (amount, user_id))
+    with transaction() as conn:
+        row = conn.execute("SELECT coins FROM user_gacha WHERE user_id=?", (user_id,)).fetchone()
+
+        if not row or row[0] < amount:
+            return False
+
+        conn.execute("""
+            UPDATE user_gacha
+            SET coins = coins - ?, updated_at=datetime('now')
+            WHERE user_id=?
+        """, (amount, user_id))
 
-    conn.commit()
-    conn.close()
     return True
 
 # -------------------------
 # キャラ所持管理
 # -------------------------
 def add_user_character(user_id, char_name, rarity):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO user_characters (user_id, char_name, rarity, obtained_at)
-        VALUES (?, ?, ?, datetime('now'))
-    """, (user_id, char_name, rarity))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO user_characters (user_id, char_name, rarity, obtained_at)
+            VALUES (?, ?, ?, datetime('now'))
+        """, (user_id, char_name, rarity))
 
 
 def load_user_characters(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT char_name, rarity FROM user_characters
-        WHERE user_id=?
-        ORDER BY obtained_at
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT char_name, rarity FROM user_characters
+            WHERE user_id=?
+            ORDER BY obtained_at
+        """, (user_id,)).fetchall()
     return [{"name": r[0], "rarity": r[1]} for r in rows]
 
 # -------------------------
 # マップコイン管理
 # -------------------------
 def has_node_coin(user_id, map_key, node_index):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT 1 FROM user_node_coins
-        WHERE user_id=? AND map_key=? AND node_index=?
-    """, (user_id, map_key, node_index))
-    r = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        r = conn.execute("""
+            SELECT 1 FROM user_node_coins
+            WHERE user_id=? AND map_key=? AND node_index=?
+        """, (user_id, map_key, node_index)).fetchone()
     return r is not None
 
 
 def collect_node_coin(user_id, map_key, node_index):
-    conn = get_conn()
-    c = conn.cursor()
+    with transaction() as conn:
+        # 取得済み防止
+        conn.execute("""
+            INSERT OR IGNORE INTO user_node_coins
+            (user_id, map_key, node_index)
+            VALUES (?, ?, ?)
+        """, (user_id, map_key, node_index))
 
-    # 取得済み防止
-    c.execute("""
-        INSERT OR IGNORE INTO user_node_coins
-        (user_id, map_key, node_index)
-        VALUES (?, ?, ?)
-    """, (user_id, map_key, node_index))
+        # ガチャコイン加算
+        add_gacha_coins(user_id, 1)
 
-    conn.commit()
-    conn.close()
-
-    # ガチャコイン加算
-    add_gacha_coins(user_id, 1)
+        emit("node_coin_collected", user_id=user_id, map_key=map_key, node_index=node_index)
 
 
 # -------------------------
@@ -768,43 +1234,169 @@ def ensure_initial_character(user_id):
     owned = {c["name"] for c in chars}
 
     if "star1_1.png" not in owned:
-        add_user_character(
-            user_id=user_id,
-            char_name="star1_1.png",
-            rarity="N"
-        )
+        with transaction() as conn:
+            add_user_character(
+                user_id=user_id,
+                char_name="star1_1.png",
+                rarity="N"
+            )
 
-        # 初期キャラを使用中に設定
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE profiles SET current_chara=? WHERE user_id=?",
-            ("star1_1.png", user_id)
-        )
-        conn.commit()
-        conn.close()
+            # 初期キャラを使用中に設定
+            conn.execute(
+                "UPDATE profiles SET current_chara=? WHERE user_id=?",
+                ("star1_1.png", user_id)
+            )
 
 # -------------------------
 # 現在のキャラを変更
 # -------------------------
 def set_current_chara(user_id, char_name):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE profiles SET current_chara=? WHERE user_id=?",
-        (char_name, user_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE profiles SET current_chara=? WHERE user_id=?",
+            (char_name, user_id)
+        )
 
 def get_current_chara(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT current_chara FROM profiles WHERE user_id=?",
-        (user_id,)
-    )
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT current_chara FROM profiles WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
     return row[0] if row and row[0] else "star1_1.png"
 
+def ensure_current_chara(user_id):
+    """使用中キャラを取得。未設定なら初期キャラを保存して返す"""
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT current_chara FROM profiles WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
+
+        # DBに値がある場合
+        if row and row[0]:
+            return row[0]
+
+        # 初期キャラ（DBにも保存しておく）
+        current = "star1_1.png"
+        conn.execute("""
+            INSERT INTO profiles (user_id, current_chara)
+            VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+            current_chara=excluded.current_chara
+            """, (user_id, current))
+    return current
+
+
+# -------------------------
+# 実行計画チェック（インデックスの回帰検出）
+# -------------------------
+def check_query_plans(user_id=0):
+    """db.py の各関数が発行するクエリを EXPLAIN QUERY PLAN で調べる。
+
+    テーブル全件スキャンやソート用の一時 B-tree を使うクエリを
+    [(SQL, 実行計画の該当行), ...] で返す。書き込みは最後にロールバックする。
+    """
+    today = date.today().isoformat()
+    calls = [
+        (login, ("", "")),
+        (get_user_profile, (user_id,)),
+        (load_username, (user_id,)),
+        (save_meal, (user_id, today, "朝食", "", 0, "[]", "")),
+        (load_meals, (user_id,)),
+        (load_meals, (user_id, today)),
+        (load_meals, (user_id, today, "朝食")),
+        (load_meals_by_category, (user_id, today)),
+        (load_nutrient_totals, (user_id, today)),
+        (load_daily_nutrient_totals, (user_id, today, today)),
+        (load_daily_activity, (user_id, today, today)),
+        (save_daily_advice, (user_id, today, "")),
+        (load_daily_advice, (user_id, today)),
+        (create_job, ("", user_id, "", {})),
+        (update_job, ("", "done")),
+        (get_job, ("",)),
+        (abort_unfinished_jobs, ("",)),
+        (purge_jobs, ()),
+        # put_cached_nutrients（LRU 削除の COUNT(*)）と load_food_composition（起動時の一括読み込み）は
+        # 意図的に全件走査なので対象外
+        (get_cached_nutrients, ([""],)),
+        (save_tomorrow_menu, (user_id, today, "")),
+        (get_tomorrow_menu, (user_id, today)),
+        (save_user_badge, (user_id, "first")),
+        (load_user_badges, (user_id,)),
+        (save_badge_progress, (user_id, {"first": 0}, today)),
+        (load_badge_progress, (user_id,)),
+        (add_exp, (user_id, 0)),
+        (add_exp, (user_id, 0)),
+        (grant_title_if_needed, (user_id, 5)),
+        (get_user_titles, (user_id,)),
+        (get_current_title, (user_id,)),
+        (set_current_title, (user_id, "")),
+        (get_streak_record, (user_id,)),
+        (ensure_map_progress, (user_id,)),
+        (get_map_progress, (user_id,)),
+        (save_map_progress, (user_id, 0, "")),
+        (get_move_count, (user_id,)),
+        (add_move_count, (user_id, 0)),
+        (consume_move_count, (user_id, 0)),
+        (consume_gacha_coin, (user_id, 0)),
+        (collect_node_coin, (user_id, "", 0)),
+        (has_node_coin, (user_id, "", 0)),
+        (get_gacha_coins, (user_id,)),
+        (add_user_character, (user_id, "", "N")),
+        (load_user_characters, (user_id,)),
+        (set_current_chara, (user_id, "")),
+        (get_current_chara, (user_id,)),
+        (ensure_current_chara, (user_id,)),
+    ]
+
+    statements = []
+    with connection() as conn:
+        conn.execute("BEGIN")
+        conn.set_trace_callback(statements.append)
+        try:
+            for fn, args in calls:
+                fn(*args)
+        finally:
+            conn.set_trace_callback(None)
+            conn.rollback()
+
+        problems = []
+        for sql in dict.fromkeys(statements):
+            if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+                continue
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql):
+                detail = row[3]
+                if detail.startswith("SCAN ") or "TEMP B-TREE" in detail:
+                    problems.append((sql.strip(), detail))
+    return problems
+
+
+# -------------------------
+# メンテナンス用コマンド
+#   python db.py backfill-summary [--user USER_ID]
+#   python db.py check-plans
+# -------------------------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="nutrition.db メンテナンス")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_backfill = sub.add_parser("backfill-summary", help="daily_nutrition_summary を meals から再集計")
+    p_backfill.add_argument("--user", type=int, default=None, help="対象ユーザ（省略時は全ユーザ）")
+
+    sub.add_parser("check-plans", help="全件スキャンになるクエリがないか確認（あれば終了コード1）")
+
+    args = parser.parse_args()
+
+    if args.command == "backfill-summary":
+        rebuild_daily_nutrition_summary(args.user)
+        print("daily_nutrition_summary を再集計しました")
+
+    elif args.command == "check-plans":
+        problems = check_query_plans()
+        for sql, detail in problems:
+            print(f"[{detail}]\n{sql}\n")
+        print("OK" if not problems else f"{len(problems)} 件のクエリがインデックスを使っていません")
+        raise SystemExit(1 if problems else 0)
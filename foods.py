@@ -0,0 +1,205 @@
+# foods.py
+import csv
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+from db import NUTRIENT_COLUMNS, load_food_composition, replace_food_composition
+
+FUZZY_THRESHOLD = 0.6   # n-gram 類似度（Dice 係数）がこれ以上なら同じ食品とみなす
+NGRAM = 2
+
+NUTRIENT_UNITS = {name: ("kcal" if name == "カロリー" else "g") for name in NUTRIENT_COLUMNS}
+
+# CSV の列名候補（日本食品標準成分表の表記ゆれに対応。単位の括弧書きは無視）
+# 前にある候補ほど優先する（八訂の 利用可能炭水化物 は 質量計 → 単糖当量 の順）
+CSV_COLUMNS = {
+    "name": ["食品名", "name", "food"],
+    "reading": ["読み", "よみ", "かな", "reading"],
+    "カロリー": ["カロリー", "エネルギー", "kcal", "calories"],
+    "たんぱく質": ["たんぱく質", "タンパク質", "protein"],
+    "炭水化物": ["炭水化物", "carbs"],
+    "脂質": ["脂質", "fat"],
+    "食物繊維": ["食物繊維", "食物繊維総量", "fiber"],
+    "糖質": ["糖質", "利用可能炭水化物（質量計）", "利用可能炭水化物", "利用可能炭水化物（単糖当量）", "sugar"],
+    "塩分": ["塩分", "食塩相当量", "salt"],
+}
+
+
+# -----------------------------
+# 名前の正規化
+# -----------------------------
+def search_key(name: str) -> str:
+    """全角/半角・大小文字・カタカナ/ひらがな・空白や記号の揺れをそろえた検索キー"""
+    name = unicodedata.normalize("NFKC", name or "").lower()
+    # カタカナ → ひらがな
+    name = "".join(chr(ord(ch) - 0x60) if "ァ" <= ch <= "ヶ" else ch for ch in name)
+    return re.sub(r"[\s\-・、。,.()\[\]（）［］「」＜＞<>/]+", "", name)
+
+
+def _ngrams(key: str):
+    if len(key) < NGRAM:
+        return {key} if key else set()
+    return {key[i:i + NGRAM] for i in range(len(key) - NGRAM + 1)}
+
+
+# -----------------------------
+# メモリ上の検索インデックス
+# -----------------------------
+class FoodIndex:
+    def __init__(self, foods):
+        self.foods = foods
+        self.exact = {}
+        self.normalized = {}
+        self.keys = []
+        self.postings = {}
+
+        for i, food in enumerate(foods):
+            self.exact.setdefault(food["name"], i)
+            keys = {search_key(food["name"]), search_key(food.get("reading"))} - {""}
+            self.keys.append([(key, _ngrams(key)) for key in keys])
+            for key in keys:
+                self.normalized.setdefault(key, i)
+                for gram in _ngrams(key):
+                    self.postings.setdefault(gram, set()).add(i)
+
+    def _fuzzy(self, key):
+        grams = _ngrams(key)
+        hits = Counter(i for gram in grams for i in self.postings.get(gram, ()))
+        best, best_score = None, 0.0
+        for i, _ in hits.most_common(20):
+            for _, food_grams in self.keys[i]:
+                score = 2 * len(grams & food_grams) / (len(grams) + len(food_grams))
+                if score > best_score:
+                    best, best_score = i, score
+        return best if best_score >= FUZZY_THRESHOLD else None
+
+    def lookup(self, name):
+        """完全一致 → 正規化一致 → あいまい一致の順に探す。見つからなければ None"""
+        i = self.exact.get(name)
+        if i is None:
+            key = search_key(name)
+            i = self.normalized.get(key)
+            if i is None and key:
+                i = self._fuzzy(key)
+        return None if i is None else self.foods[i]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_food_index():
+    """成分表のインデックス（プロセスで1回だけ構築）"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = FoodIndex(load_food_composition())
+    return _index
+
+
+def reload_food_index():
+    global _index
+    with _index_lock:
+        _index = FoodIndex(load_food_composition())
+
+
+def lookup_nutrients(food_name, grams):
+    """成分表から grams あたりの栄養素リストを返す。見つからなければ None"""
+    food = get_food_index().lookup(food_name)
+    if food is None:
+        return None
+    factor = float(grams) / 100
+    return [
+        {"name": name, "value": round((food.get(name) or 0) * factor, 2), "unit": NUTRIENT_UNITS[name]}
+        for name in NUTRIENT_COLUMNS
+    ]
+
+
+# -----------------------------
+# CSV 取り込み
+# -----------------------------
+def _parse_value(text):
+    """成分表の表記（"Tr", "(0.5)", "-", "" など）を数値にする"""
+    text = (text or "").strip().strip("()（）")
+    try:
+        return float(text)
+    except ValueError:
+        return 0.0
+
+
+_UNIT_PATTERN = re.compile(r"\(\s*(kj|kcal|g|mg)\s*\)", re.IGNORECASE)
+
+
+def _header_key(header):
+    """列名の照合キー。単位の括弧書きだけ外す（"（質量計）" などは別の列なので残す）"""
+    header = unicodedata.normalize("NFKC", header or "")
+    return re.sub(r"\s", "", _UNIT_PATTERN.sub("", header)).lower()
+
+
+def _header_unit(header):
+    """列名の括弧書きの単位（"エネルギー（kJ）" → "kj"）。なければ空文字"""
+    m = _UNIT_PATTERN.search(unicodedata.normalize("NFKC", header or ""))
+    return m.group(1).lower() if m else ""
+
+
+def read_food_csv(path):
+    """CSV を読み、replace_food_composition に渡せる形で返す"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        columns = {}
+        for field, candidates in CSV_COLUMNS.items():
+            columns[field] = None
+            for candidate in candidates:
+                matches = [h for h in reader.fieldnames if _header_key(h) == _header_key(candidate)]
+                if field == "カロリー":
+                    # 成分表には エネルギー（kJ）と エネルギー（kcal）の両方があるので kJ の列は使わない
+                    matches = [h for h in matches if _header_unit(h) != "kj"]
+                if len(matches) > 1:
+                    raise ValueError(f"「{field}」に当たる列が複数あります: {', '.join(matches)}")
+                if matches:
+                    columns[field] = matches[0]
+                    break
+        if columns["name"] is None:
+            raise ValueError("食品名の列が見つかりません")
+
+        foods = []
+        for row in reader:
+            name = (row.get(columns["name"]) or "").strip()
+            if not name:
+                continue
+            reading = (row.get(columns["reading"]) or "").strip() if columns["reading"] else ""
+            food = {"name": name, "reading": reading or None}
+            for nutrient in NUTRIENT_COLUMNS:
+                col = columns[nutrient]
+                food[nutrient] = _parse_value(row.get(col)) if col else None
+
+            # 糖質の列がなければ 炭水化物 − 食物繊維 で補う
+            if food["糖質"] is None:
+                food["糖質"] = max((food["炭水化物"] or 0) - (food["食物繊維"] or 0), 0)
+            for nutrient in NUTRIENT_COLUMNS:
+                food[nutrient] = food[nutrient] or 0
+            foods.append(food)
+    return foods
+
+
+# -------------------------
+# 取り込みコマンド
+#   python foods.py import 食品成分表.csv
+# -------------------------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="食品成分表の管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="CSV（100gあたり）から成分表を入れ替える")
+    p_import.add_argument("csv_path")
+
+    args = parser.parse_args()
+
+    if args.command == "import":
+        foods = read_food_csv(args.csv_path)
+        replace_food_composition(foods)
+        print(f"{len(foods)} 件の食品を取り込みました（起動中のアプリには管理者ページの「食品成分表を読み直す」で反映）")
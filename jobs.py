@@ -0,0 +1,153 @@
+# jobs.py
+import json
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from db import create_job, update_job, get_job, abort_unfinished_jobs, purge_jobs, save_meal, add_exp, add_move_count, save_daily_advice, save_tomorrow_menu
+from utils import llm
+from badges import subscribe_events
+
+# -----------------------------
+# バックグラウンドジョブ
+#   AI 呼び出しをスクリプトスレッドから切り離し、ページは job_id で結果を待つ
+# -----------------------------
+MAX_WORKERS = 4         # 同時に実行する AI 呼び出しの上限
+JOB_RETENTION_DAYS = 7  # 終わったジョブを残す日数
+PROGRESS_INTERVAL_SEC = 0.2  # ストリームの途中経過を保存する間隔（ページも同じ間隔で読む）
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="ai-job")
+_handlers = {}
+_current = threading.local()
+
+
+def register(kind):
+    """ジョブ種別のハンドラを登録するデコレータ。戻り値は JSON にできる値にする"""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def report_progress(result):
+    """実行中のジョブの途中経過を保存する（ハンドラの中から呼ぶ）"""
+    job_id = getattr(_current, "job_id", None)
+    if job_id:
+        update_job(job_id, "running", result=result)
+
+
+def _run(job_id, kind, payload):
+    update_job(job_id, "running")
+    _current.job_id = job_id
+    try:
+        result = _handlers[kind](**payload)
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job_id, "error", error=str(e) or type(e).__name__)
+    else:
+        update_job(job_id, "done", result=result)
+    finally:
+        _current.job_id = None
+
+
+def submit(user_id, kind, **payload):
+    """ジョブを登録してすぐに job_id を返す"""
+    if kind not in _handlers:
+        raise ValueError(f"unknown job kind: {kind}")
+    job_id = uuid.uuid4().hex
+    create_job(job_id, user_id, kind, payload)
+    _executor.submit(_run, job_id, kind, payload)
+    return job_id
+
+
+def get(job_id):
+    """ジョブの状態を返す（queued / running / done / error）"""
+    return get_job(job_id)
+
+
+# -----------------------------
+# ジョブ種別
+# -----------------------------
+MEAL_EXP_BASE = 5   # 全食事共通ベース
+MEAL_EXP_BONUS = {
+    "朝食": 3,      # 生活リズム重視
+    "昼食": 2,      # 活動の中心
+    "夕食": 1,      # 締め
+    "間食": 0,      # おまけ枠
+}
+
+
+def _reward_meal(meal):
+    """食事を保存したときの経験値と冒険ポイント（ページを閉じていても付与されるようジョブ側で行う）"""
+    exp_gain = MEAL_EXP_BASE + MEAL_EXP_BONUS.get(meal["category"], 0)
+    add_exp(meal["user_id"], exp_gain)
+    move_added = add_move_count(meal["user_id"], 1)
+    return {"exp_gain": exp_gain, "move_added": bool(move_added)}
+
+
+@register("analyze_food_multi")
+def _analyze_food_multi(food_list, user_info=None, meal=None):
+    """meal={"user_id", "date", "category"} があれば、栄養素が確定した食品から順に保存し、
+    1件でも保存できたら経験値と冒険ポイントを付与する（途中で失敗しても保存済みの分は付与する）
+    """
+    done = []
+
+    def on_item(item):
+        if meal:
+            save_meal(
+                meal["user_id"], meal["date"], meal["category"],
+                item["food"], item["grams"],
+                json.dumps(item["nutrients"], ensure_ascii=False),
+                ""
+            )
+        done.append(item)
+        report_progress({"items": done})
+
+    reward = {}
+    try:
+        result = llm.analyze_food_multi(food_list, user_info=user_info, on_item=on_item)
+    finally:
+        if meal and done:
+            reward = _reward_meal(meal)
+    return {**result, **reward}
+
+
+def _stream_text(chunks):
+    """文字のストリームを連結しながら、途中経過を一定間隔で保存する（最初の文字は届いたらすぐ）"""
+    text, reported = "", None
+    for chunk in chunks:
+        text += chunk
+        if reported is None or time.monotonic() - reported >= PROGRESS_INTERVAL_SEC:
+            report_progress({"text": text})
+            reported = time.monotonic()
+    return text
+
+
+@register("daily_advice")
+def _daily_advice(nutri_total, nutrient_targets, day):
+    """day={"user_id", "date"}。生成が終わったらその日のアドバイスとして保存する"""
+    text = _stream_text(llm.stream_daily_advice(nutri_total, nutrient_targets))
+    save_daily_advice(day["user_id"], day["date"], text)
+    return {"text": text}
+
+
+@register("tomorrow_menu")
+def _tomorrow_menu(today_advice, nutri_total, nutrient_targets, day):
+    """day={"user_id", "date"}。生成が終わったらその日の「明日の献立」として保存する"""
+    text = _stream_text(llm.stream_tomorrow_menu(
+        today_advice=today_advice,
+        nutri_total=nutri_total,
+        nutrient_targets=nutrient_targets
+    ))
+    save_tomorrow_menu(day["user_id"], day["date"], text)
+    return {"text": text}
+
+
+# 起動時：食事保存でバッジ進捗が更新されるようにする
+subscribe_events()
+
+# 起動時：前回のプロセスで中断したジョブを片付ける
+abort_unfinished_jobs("サーバ再起動のため中断されました")
+purge_jobs(JOB_RETENTION_DAYS)
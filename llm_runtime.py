@@ -0,0 +1,245 @@
+# llm_runtime.py
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# -----------------------------
+# 同一リクエストの相乗り（single-flight）
+#   同じ key の呼び出しが実行中なら、新しく呼ばずにその結果を待って共有する
+# -----------------------------
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"calls": 0, "executed": 0, "coalesced": 0, "max_waiters": 0}
+
+    def do(self, key, func):
+        """func() を実行して (結果, 相乗りしたか) を返す。例外も待っている全員に伝わる"""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats["executed"] += 1
+            else:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                self._stats["max_waiters"] = max(self._stats["max_waiters"], call.waiters)
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def summary(self):
+        """{"calls", "executed", "coalesced", "max_waiters", "in_flight"}"""
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+
+# -----------------------------
+# マイクロバッチ
+#   短い時間窓に集まった要求（セッションをまたぐ）を1回の handler 呼び出しにまとめる
+# -----------------------------
+class MicroBatcher:
+    def __init__(self, handler, window=0.1, max_batch=20, max_workers=4):
+        """handler(batch, resolve)
+
+        batch は [(key, payload), ...]。handler は結果が出た要求から resolve(key, value) を呼ぶ。
+        handler が終わっても resolve されなかった要求の結果は None になる。
+        """
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}    # 次に送るバッチ key -> (payload, future)
+        self._inflight = {}   # 送信済みで結果待ち key -> future
+        self._timer = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-batch")
+        self._stats = {"submitted": 0, "deduped": 0, "batches": 0, "items": 0, "max_batch": 0}
+
+    def submit(self, key, payload):
+        """要求を登録して Future を返す。同じ key が待ち中・送信中ならその Future を共有する"""
+        with self._lock:
+            self._stats["submitted"] += 1
+            fut = self._inflight.get(key) or (self._pending.get(key) or (None, None))[1]
+            if fut is not None:
+                self._stats["deduped"] += 1
+                return fut
+
+            fut = Future()
+            self._pending[key] = (payload, fut)
+            if len(self._pending) >= self.max_batch:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return fut
+
+    def _flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        for key, (_, fut) in batch.items():
+            self._inflight[key] = fut
+        self._stats["batches"] += 1
+        self._stats["items"] += len(batch)
+        self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+        self._executor.submit(self._run, batch)
+
+    def _finish(self, key, fut, value=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if fut.done():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(value)
+
+    def _run(self, batch):
+        def resolve(key, value):
+            if key in batch:
+                self._finish(key, batch[key][1], value)
+
+        error = None
+        try:
+            self.handler([(key, payload) for key, (payload, _) in batch.items()], resolve)
+        except Exception as e:
+            error = e
+        for key, (_, fut) in batch.items():
+            self._finish(key, fut, error=error)
+
+    def summary(self):
+        """{"submitted", "deduped", "batches", "items", "max_batch", "avg_batch", "pending", "in_flight"}"""
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                **self._stats,
+                "avg_batch": round(self._stats["items"] / batches, 2) if batches else 0,
+                "pending": len(self._pending),
+                "in_flight": len(self._inflight),
+            }
+
+
+# -----------------------------
+# レート制限つきスケジューラ
+#   1分あたりのリクエスト数・トークン数をトークンバケットで守り、
+#   枠が空くまで待たせる（失敗にはしない）。待ち行列は priority の小さい順
+# -----------------------------
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """amount 使えるようになるまでの秒数"""
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+
+class RateScheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute, window=200):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.window = window
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._waits = {}
+        self._stats = {"granted": 0, "max_queue": 0}
+
+    def acquire(self, priority=0, tokens=1):
+        """枠が空くまで待ってから1リクエスト分と tokens を消費する。待った秒数を返す"""
+        tokens = min(tokens, self.tokens.capacity)
+        start = time.monotonic()
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._queue, entry)
+            self._stats["max_queue"] = max(self._stats["max_queue"], len(self._queue))
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                if self._queue[0] != entry:
+                    # 先頭（より優先度の高い・先に来た要求）が通るまで待つ
+                    self._cond.wait()
+                    continue
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                heapq.heappop(self._queue)
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+                waited = now - start
+                self._stats["granted"] += 1
+                self._waits.setdefault(priority, deque(maxlen=self.window)).append(waited)
+                self._cond.notify_all()
+                return waited
+
+    def settle(self, estimated, actual):
+        """見積もりと実際の使用トークン数の差をバケットに反映する（超過分は後の要求が待つ）"""
+        with self._cond:
+            self.tokens.refill(time.monotonic())
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level - (actual - estimated))
+            self._cond.notify_all()
+
+    def summary(self):
+        """{"queue_depth", "max_queue", "granted", "requests_left", "tokens_left", "waits": {priority: {...}}}"""
+        with self._cond:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            waits = {}
+            for priority, values in sorted(self._waits.items()):
+                lat = sorted(values)
+                waits[priority] = {
+                    "count": len(lat),
+                    "avg_ms": round(sum(lat) / len(lat) * 1000, 1),
+                    "p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000, 1),
+                }
+            return {
+                **self._stats,
+                "queue_depth": len(self._queue),
+                "requests_left": int(self.requests.level),
+                "tokens_left": int(self.tokens.level),
+                "waits": waits,
+            }
@@ -1,9 +1,9 @@
 # pages/02_MealInput.py
 
 import streamlit as st
-from db import save_meal, get_user_profile, load_meals, add_exp, save_daily_advice, load_daily_advice, get_tomorrow_menu, save_tomorrow_menu, get_daily_advice, add_move_count
-from utils import gemini_model, calc_nutrient_targets
-import json
+from db import get_user_profile, load_meals_by_category, load_nutrient_totals, load_daily_advice, get_tomorrow_menu, get_daily_advice
+from utils import calc_nutrient_targets
+import jobs
 import datetime
 import pandas as pd
 from utils import load_css
@@ -53,6 +53,74 @@ def nutrient_bar(name, value, target):
         unsafe_allow_html=True
     )
 
+# -----------------------------------------
+# 🔄 ローディング表示
+# -----------------------------------------
+def render_loading(message):
+    col_img, col_text = st.columns([1, 3])
+
+    with col_img:
+        st.image("assets/images/loading_man.gif", width=120)
+
+    with col_text:
+        st.markdown(
+            f"""
+            <div style="
+                display:flex;
+                align-items:center;
+                height:100%;
+                font-size:26px;
+            ">
+                {message}
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+
+# -----------------------------------------
+# AIジョブの完了待ち（このブロックだけ定期的に再描画）
+#   st.session_state[slot] = {"id": job_id, ...} が登録されている間だけ表示
+#   on_progress があれば実行中の途中経過（job["result"]）も表示する
+#   文章の生成は最初の文字をすぐ見せたいので watch_stream で短い間隔で読む
+# -----------------------------------------
+STREAM_POLL_SEC = jobs.PROGRESS_INTERVAL_SEC
+
+
+def poll_job(slot, message, on_done, on_progress=None):
+    info = st.session_state.get(slot)
+    if not info:
+        return
+
+    job = jobs.get(info["id"])
+    if job and job["status"] in ("queued", "running"):
+        render_loading(message)
+        if on_progress and job["result"]:
+            on_progress(job["result"])
+        return
+
+    # 完了（または失敗）したらページ全体を描き直す
+    del st.session_state[slot]
+    if job is None or job["status"] == "error":
+        st.session_state["job_error"] = (job or {}).get("error") or "AIの処理に失敗しました"
+    else:
+        on_done(info, job["result"])
+    st.rerun(scope="app")
+
+
+@st.fragment(run_every=1)
+def watch_job(slot, message, on_done, on_progress=None):
+    poll_job(slot, message, on_done, on_progress)
+
+
+@st.fragment(run_every=STREAM_POLL_SEC)
+def watch_stream(slot, message, on_done):
+    poll_job(slot, message, on_done, lambda result: st.write(result.get("text", "")))
+
+
+# 前回のジョブの失敗を表示
+if "job_error" in st.session_state:
+    st.error(f"AIの処理に失敗しました：{st.session_state.pop('job_error')}")
+
 # ============================
 # 🔽 日付の選択
 # ============================
@@ -67,17 +135,9 @@ with tab1:
     # ============================
     st.subheader("📊 栄養素グラフ")
 
-    today_meals = load_meals(user_id, date=selected_date_str)
-
-    nutri_total = {k: 0 for k in NUTRIENT_TARGETS.keys()}
-
-    for meal in today_meals:
-        arr = json.loads(meal["nutrients"])
-        for item in arr:
-            name = item.get("name")
-            value = float(item.get("value", 0))
-            if name in nutri_total:
-                nutri_total[name] += value
+    # 数値カラムを SQL で集計（JSON のパースは不要）
+    day_totals = load_nutrient_totals(user_id, selected_date_str)
+    nutri_total = {k: day_totals.get(k, 0) for k in NUTRIENT_TARGETS.keys()}
 
     # 表示
     cols = st.columns(2)
@@ -94,12 +154,13 @@ with tab1:
 
     categories = ["朝食", "昼食", "夕食", "間食"]
 
+    # DB から1回で取得（区分ごとにまとめ済み）
+    meals_by_category = load_meals_by_category(user_id, selected_date_str)
+
     for cat in categories:
         st.markdown(f"### 🟢 {cat}")
 
-        # DB から取得
-        meals = load_meals(user_id, date=selected_date_str, category=cat)
-
+        meals = meals_by_category.get(cat, [])
 
         if not meals:
             st.write("（記録なし）")
@@ -109,10 +170,7 @@ with tab1:
         for m in meals:
             food = m["food"]
             grams = m["grams"]
-            nutrients = json.loads(m["nutrients"])
-
-            # 栄養素を辞書に変換
-            nutrient_dict = {x["name"]: x["value"] for x in nutrients}
+            nutrient_dict = m["nutrients"]
 
             cal = nutrient_dict.get("カロリー", 0)
             protein = nutrient_dict.get("たんぱく質", 0)
@@ -135,13 +193,13 @@ with tab1:
                     align-items:center;
                 ">
                     <b>{food}</b>（{grams}g）  
-                    <span>カロリー: {cal} kcal</span>
-                    <span>たんぱく質: {protein} g</span>
-                    <span>脂質: {fat} g</span>
-                    <span>炭水化物: {carbs} g</span>
-                    <span>食物繊維: {fiber} g</span>
-                    <span>糖質: {sugar} g</span>
-                    <span>塩分: {salt} g</span>
+                    <span>カロリー: {cal:g} kcal</span>
+                    <span>たんぱく質: {protein:g} g</span>
+                    <span>脂質: {fat:g} g</span>
+                    <span>炭水化物: {carbs:g} g</span>
+                    <span>食物繊維: {fiber:g} g</span>
+                    <span>糖質: {sugar:g} g</span>
+                    <span>塩分: {salt:g} g</span>
                 </div>
                 """,
                 unsafe_allow_html=True
@@ -208,35 +266,25 @@ with tab1:
     category = st.selectbox("食事区分", ["朝食", "昼食", "夕食", "間食"])
 
     # =======================================================
-    # 🚀 AI解析して一括保存（APIは1回だけ）
+    # 🚀 AI解析して一括保存（APIは1回だけ・バックグラウンドで実行）
+    #   DB保存はジョブ側で食品ごとに済んでいる（解析できた順に保存）
     # =======================================================
-    if st.button("AIで解析して保存"):
-
-        loading = st.empty()
-
-        # ===============================
-        # 🔄 ローディング表示
-        # ===============================
-        with loading.container():
-            col_img, col_text = st.columns([1, 3])
-
-            with col_img:
-                st.image("assets/images/loading_man.gif", width=120)
-
-            with col_text:
-                st.markdown(
-                    """
-                    <div style="
-                        display:flex;
-                        align-items:center;
-                        height:100%;
-                        font-size:26px;
-                    ">
-                        AIで解析中...
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+    def on_analyzed_item(result):
+        for item in result.get("items", []):
+            kcal = next((n["value"] for n in item["nutrients"] if n["name"] == "カロリー"), 0)
+            st.write(f"✅ {item['food']}（{item['grams']}g）: {kcal:g} kcal")
+
+    def on_analyzed(info, result):
+        # 経験値・冒険ポイントはジョブ側で付与済み。ここでは結果を知らせるだけ
+        if result.get("failed"):
+            st.session_state["job_error"] = "次の食品は解析できませんでした：" + "、".join(result["failed"])
+        if not result.get("items"):
+            return
+        if result.get("move_added"):
+            st.toast("🚶‍♂️ 冒険ポイント +1！")
+        st.toast(f"保存しました！経験値 +{result.get('exp_gain', 0)} 🎉")
+
+    if st.button("AIで解析して保存", disabled="analyze_job" in st.session_state):
 
         food_list = [
             {"food": f["food"].strip(), "grams": f["grams"]}
@@ -244,191 +292,91 @@ with tab1:
         ]
 
         if not food_list:
-            loading.empty()
             st.warning("食品を入力してください")
             st.stop()
 
         # ---------------------------------------
-        # 🚀 API1回だけ呼び出す
-        # ---------------------------------------
-        result = gemini_model.analyze_food_multi(food_list, user_info=profile)
-
-        items = result.get("items", [])
-        total = result.get("total", [])
-        advice = result.get("advice", "")
-
-        # ---------------------------------------
-        # DB保存
+        # 🚀 API1回だけ呼び出す（結果は watch_job で受け取る）
         # ---------------------------------------
-        for item in items:
-            save_meal(
-                user_id,
-                selected_date_str,
-                category,
-                item["food"],
-                item["grams"],
-                json.dumps(item["nutrients"], ensure_ascii=False),
-                ""   # ← アドバイス保存しない
-            )
-
-        # ---------------------------------------
-        # 経験値
-        # ---------------------------------------
-        exp_gain = 5  # 全食事共通ベース
-
-        if category == "朝食":
-            exp_gain += 3      # 生活リズム重視
-        elif category == "昼食":
-            exp_gain += 2      # 活動の中心
-        elif category == "夕食":
-            exp_gain += 1      # 締め
-        elif category == "間食":
-            exp_gain += 0      # おまけ枠
-
-        add_exp(user_id, exp_gain)
-
-        # ---------------------------------------
-        # 結果表示
-        # ---------------------------------------
-        loading.empty()
-
-        added = add_move_count(user_id, 1)
-        if added:
-            st.toast("🚶‍♂️ 冒険ポイント +1！")
-
-        st.success(f"保存しました！経験値 +{exp_gain} 🎉")
-
-        st.subheader("📊 全食品の解析結果")
-        st.json(items)
-
-        st.subheader("🔥 合計栄養素")
-        st.json(total)
-
-        st.info(advice)
-
-        st.rerun()
+        st.session_state["analyze_job"] = {
+            "id": jobs.submit(
+                user_id, "analyze_food_multi",
+                food_list=food_list,
+                user_info=profile,
+                meal={"user_id": user_id, "date": selected_date_str, "category": category},
+            ),
+            "date": selected_date_str,
+            "category": category,
+        }
+
+    if "analyze_job" in st.session_state:
+        watch_job("analyze_job", "AIで解析中...", on_analyzed, on_progress=on_analyzed_item)
 
 with tab2:
     # =============================
     # 🍀 今日の食事アドバイス（総括）
+    #   生成はバックグラウンドのジョブで行い、届いた文字から順に watch_stream で表示する
+    #   （保存もジョブ側で行うので、ページを閉じても生成した分は残る）
     # =============================
     st.subheader("🍀 今日の食事アドバイス")
 
-    # ① 保存済みアドバイスを読込
-    saved_advice = load_daily_advice(user_id, selected_date_str)
-
-    if saved_advice:
-        st.write(saved_advice)
+    def on_advice(info, result):
+        st.toast("アドバイスを生成しました！")
+
+    if st.button("🌟 この日のアドバイスを生成", disabled="advice_job" in st.session_state):
+        st.session_state["advice_job"] = {
+            "id": jobs.submit(
+                user_id, "daily_advice",
+                nutri_total=nutri_total,
+                nutrient_targets=NUTRIENT_TARGETS,
+                day={"user_id": user_id, "date": selected_date_str},
+            ),
+            "date": selected_date_str,
+        }
+
+    if "advice_job" in st.session_state:
+        watch_stream("advice_job", "🌟 この日のアドバイスを生成中...", on_advice)
     else:
-        st.info("この日はまだアドバイスが生成されていません。")
-
-    # ② 生成ボタン
-    if st.button("🌟 この日のアドバイスを生成"):
-        loading = st.empty()
-
-        # ===============================
-        # 🔄 ローディング表示
-        # ===============================
-        with loading.container():
-            col_img, col_text = st.columns([1, 3])
-
-            with col_img:
-                st.image("assets/images/loading_man.gif", width=120)
-
-            with col_text:
-                st.markdown(
-                    """
-                    <div style="
-                        display:flex;
-                        align-items:center;
-                        height:100%;
-                        font-size:26px;
-                    ">
-                        🌟 この日のアドバイスを生成中...
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-        advice = gemini_model.generate_daily_advice(
-            nutri_total,
-            NUTRIENT_TARGETS
-        )
-
-
-        save_daily_advice(user_id, selected_date_str, advice)
+        # 保存済みアドバイスを表示
+        saved_advice = load_daily_advice(user_id, selected_date_str)
 
-        loading.empty()
-        st.success("アドバイスを生成しました！")
-        st.write(advice)
-        st.rerun()
+        if saved_advice:
+            st.write(saved_advice)
+        else:
+            st.info("この日はまだアドバイスが生成されていません。")
 
     # =============================
     # 🍱 明日の献立生成
     # =============================
     st.subheader("🍱 明日の献立を自動生成")
 
-    menu_text = get_tomorrow_menu(user_id, selected_date_str)
+    def on_menu(info, result):
+        st.toast("明日の献立を保存しました！")
 
-    if menu_text:
-        st.info(menu_text)
-    else:
-        st.warning("まだ明日の献立がありません。")
-    
-    if st.button("✨ 明日の献立を生成"):
-
-        loading = st.empty()
-
-        # ===============================
-        # 🔄 ローディング表示
-        # ===============================
-        with loading.container():
-            col_img, col_text = st.columns([1, 3])
-
-            with col_img:
-                st.image("assets/images/loading_man.gif", width=120)
-
-            with col_text:
-                st.markdown(
-                    """
-                    <div style="
-                        display:flex;
-                        align-items:center;
-                        height:100%;
-                        font-size:26px;
-                    ">
-                        🍳 明日の献立を作成中...
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-        # ===============================
-        # 処理開始
-        # ===============================
+    if st.button("✨ 明日の献立を生成", disabled="menu_job" in st.session_state):
         advice_text = get_daily_advice(user_id, selected_date_str)
 
         if not advice_text:
-            loading.empty()
             st.error("先に『今日のアドバイス』を生成してください。")
             st.stop()
 
-        menu = gemini_model.generate_tomorrow_menu(
-            today_advice=advice_text,
-            nutri_total=nutri_total,
-            nutrient_targets=NUTRIENT_TARGETS
-        )
-
-        save_tomorrow_menu(user_id, selected_date_str, menu)
-
-        # ===============================
-        # ✅ 処理完了
-        # ===============================
-        loading.empty()
-        st.success("明日の献立を保存しました！")
-        st.rerun()
-
-
-
-
+        st.session_state["menu_job"] = {
+            "id": jobs.submit(
+                user_id, "tomorrow_menu",
+                today_advice=advice_text,
+                nutri_total=nutri_total,
+                nutrient_targets=NUTRIENT_TARGETS,
+                day={"user_id": user_id, "date": selected_date_str},
+            ),
+            "date": selected_date_str,
+        }
+
+    if "menu_job" in st.session_state:
+        watch_stream("menu_job", "🍳 明日の献立を作成中...", on_menu)
+    else:
+        menu_text = get_tomorrow_menu(user_id, selected_date_str)
 
+        if menu_text:
+            st.info(menu_text)
+        else:
+            st.warning("まだ明日の献立がありません。")
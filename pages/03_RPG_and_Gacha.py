@@ -1,10 +1,11 @@
 # pages/03_RPG_and_Gacha.py
 import streamlit as st
-import os, random, time
-from db import load_username, get_progress, add_exp, LEVEL_EXP, get_consecutive_days, get_map_progress, save_map_progress, consume_gacha_coin, get_gacha_coins, add_user_character, load_user_characters, get_conn, has_node_coin, collect_node_coin, ensure_initial_character, set_current_chara, get_current_chara, get_user_titles, get_move_count, consume_move_count, add_move_count
+import os, random
+from db import load_username, get_progress, add_exp, LEVEL_EXP, get_streak_record, get_map_progress, save_map_progress, consume_gacha_coin, get_gacha_coins, add_user_character, load_user_characters, has_node_coin, collect_node_coin, ensure_initial_character, set_current_chara, get_current_chara, get_user_titles, get_move_count, consume_move_count, add_move_count, get_current_title, set_current_title, ensure_current_chara, ensure_map_progress
 from utils import load_css
+from characters import RARITY_LABELS, RARITY_EGG, RARITY_BREAK, GACHA_ANIM_MS, gacha_animation_url, get_catalog, prebuild_animations
+from asset_store import asset_url, optimized_path, thumbnail_path, thumbnail_url, GRID_THUMB, PORTRAIT_THUMB, GACHA_THUMB
 from dataclasses import dataclass
-from datetime import datetime
 from components.render_sidebar import render_sidebar
 
 load_css("styles.css")
@@ -19,6 +20,7 @@ if "username" not in st.session_state:
     st.session_state["username"] = load_username(user_id)
 
 ensure_initial_character(user_id)
+catalog = get_catalog()
 
 
 # ==========================
@@ -40,15 +42,7 @@ with tab_rpg:
     next_req = LEVEL_EXP.get(next_level, LEVEL_EXP[level])
 
     # 使用中称号取得
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT current_title FROM profiles WHERE user_id=?",
-        (user_id,)
-    )
-    row = c.fetchone()
-    conn.close()
-    current_title = row[0] if row and row[0] else "無名"
+    current_title = get_current_title(user_id)
 
     st.markdown(
         f"### 🏷️ 称号：**{current_title}**"
@@ -62,40 +56,13 @@ with tab_rpg:
     # 使用中キャラを取得（完全安定版）
     # --------------------------
     if "current_chara" not in st.session_state:
-        conn = get_conn()
-        c = conn.cursor()
-
-        c.execute(
-            "SELECT current_chara FROM profiles WHERE user_id=?",
-            (user_id,)
-        )
-        row = c.fetchone()
-
-        # DBに値がある場合
-        if row and row[0]:
-            current = row[0]
-        else:
-            # 初期キャラ
-            current = "star1_1.png"
-            # ★ DBにも保存しておく（超重要）
-            c.execute("""
-                INSERT INTO profiles (user_id, current_chara)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                current_chara=excluded.current_chara
-                """, (user_id, current))
-            conn.commit()
-
-        conn.close()
-
-        st.session_state["current_chara"] = current
+        st.session_state["current_chara"] = ensure_current_chara(user_id)
 
     # キャラ画像
     with col1:
         char_file = st.session_state["current_chara"]
-        img_path = f"assets/images/characters/{char_file}"
-        if os.path.exists(img_path):
-            st.image(img_path, width=240)
+        if char_file in catalog:
+            st.image(thumbnail_path(catalog.path(char_file), PORTRAIT_THUMB), width=240)
         else:
             st.markdown(
                 "<div style='width:240px;height:240px;background:#333;color:white;"
@@ -110,6 +77,9 @@ with tab_rpg:
         st.markdown(f"#### 経験値: {exp} / {next_req}")
         st.progress(exp / next_req if next_req > 0 else 1.0)
 
+        streak = get_streak_record(user_id)
+        st.markdown(f"🔥 連続記録: **{streak['current']}日**（最長 {streak['longest']}日）")
+
         st.markdown("""
         この画面では、あなたの生活習慣が **キャラクターの成長** につながります。
 
@@ -147,14 +117,7 @@ with tab_rpg:
             key=f"title_{title}",
             disabled=(title == current_title)
         ):
-            conn = get_conn()
-            c = conn.cursor()
-            c.execute(
-                "UPDATE profiles SET current_title=? WHERE user_id=?",
-                (title, user_id)
-            )
-            conn.commit()
-            conn.close()
+            set_current_title(user_id, title)
             st.rerun()
 
 
@@ -164,8 +127,6 @@ with tab_rpg:
 with tab_gacha:
     import random
     import os
-    import time
-    from PIL import Image
 
     st.title("🎰 ガチャガチャ")
 
@@ -181,14 +142,7 @@ with tab_gacha:
     
     BASE = "assets/images"
     EGG_PATH = f"{BASE}/eggs"
-    CHAR_PATH = f"{BASE}/characters"
 
-    # レアリティ（番号→表示ラベル）
-    RARITY_LABELS = {1: "N", 2: "R", 3: "SR", 4: "UR", 5: "LEGEND"}
-
-    # 画像関連は番号キーで保持（壊れにくい）
-    RARITY_EGG = {1: "egg_n.png", 2: "egg_r.png", 3: "egg_sr.png", 4: "egg_ur.png", 5: "egg_lr.png"}
-    RARITY_BREAK = {1: "egg_break_n.png", 2: "egg_break_r.png", 3: "egg_break_sr.png", 4: "egg_break_ur.png", 5: "egg_break_lr.png"}
     RARITY_PROBS = {1: 0.60, 2: 0.20, 3: 0.12, 4: 0.06, 5: 0.02}
 
     # 初期化
@@ -196,6 +150,11 @@ with tab_gacha:
         st.session_state.result = None
     if "mode" not in st.session_state:
         st.session_state.mode = "normal"  # normal / anim / result
+    if "gacha_pulls" not in st.session_state:
+        st.session_state.gacha_pulls = 0
+
+    # まだ作っていない演出アニメを裏で作っておく（引いたときに合成を待たせない）
+    prebuild_animations()
 
     # --------------------------
     # Utility
@@ -205,100 +164,18 @@ with tab_gacha:
         weights = list(RARITY_PROBS.values())
         return random.choices(ids, weights=weights, k=1)[0]
 
-    def load_characters():
-        # return dict: rarity_num -> [files]
-        data = {k: [] for k in RARITY_LABELS.keys()}
-        try:
-            for file in os.listdir(CHAR_PATH):
-                if not (file.lower().endswith(".png") or file.lower().endswith(".jpg") or file.lower().endswith(".jpeg")):
-                    continue
-                # try to extract rarity digit from filename (convention dependent)
-                # fallback: place into a pool (e.g., N)
-                try:
-                    rar_num = int(file[4])
-                except Exception:
-                    # If filename pattern not match, put into '1' (N) bucket to avoid empty lists
-                    rar_num = 1
-                if rar_num in data:
-                    data[rar_num].append(file)
-        except FileNotFoundError:
-            # folder missing -> keep empty lists
-            pass
-        return data
-
-    def get_character(rarity_num, chars):
-        lst = chars.get(rarity_num, [])
-        if not lst:
-            # fallback to any available character
-            all_files = sum(chars.values(), [])
-            if not all_files:
-                return None
-            return random.choice(all_files)
-        return random.choice(lst)
-
-    # --------------------------
-    # 合成アニメ（マシンを背景にPILで合成）
-    # --------------------------
-    def play_machine_roll(egg_path, break_path, char_path):
-        placeholder = st.empty()
-        try:
-            machine = Image.open(f"{BASE}/gacha_machine.png").convert("RGBA")
-        except Exception:
-            # fallback: create blank canvas
-            machine = Image.new("RGBA", (480, 360), (240, 240, 240, 255))
-
-        # load assets safely
-        try:
-            egg = Image.open(egg_path).convert("RGBA")
-        except Exception:
-            egg = Image.new("RGBA", (140, 140), (255, 200, 200, 255))
-        try:
-            break_img = Image.open(break_path).convert("RGBA")
-        except Exception:
-            break_img = Image.new("RGBA", (200, 200), (255, 220, 220, 255))
-        try:
-            char = Image.open(char_path).convert("RGBA")
-        except Exception:
-            char = Image.new("RGBA", (240, 240), (200, 255, 200, 255))
-
-        egg = egg.resize((140, 140))
-        break_img = break_img.resize((200, 200))
-
-        # 1) 転がり
-        for x in range(-140, 100, 20):
-            frame = machine.copy()
-            angle = (x * 5) % 360
-            egg_rot = egg.rotate(angle, expand=True)
-            # position might go out of bounds; that's okay
-            frame.paste(egg_rot, (x, 260), egg_rot)
-            placeholder.image(frame)
-            time.sleep(0.05)
-
-        # 2) 止まる
-        frame = machine.copy()
-        frame.paste(egg, (80, 260), egg)
-        placeholder.image(frame)
-        time.sleep(0.25)
-
-        # 3) 割れる
-        frame = machine.copy()
-        frame.paste(break_img, (50, 240), break_img)
-        placeholder.image(frame)
-        time.sleep(0.35)
-
-        # 4) キャラ登場（拡大）
-        for scale in [0.3, 0.5, 0.7, 0.85, 1.0]:
-            frame = machine.copy()
-            w = max(1, int(char.width * scale))
-            h = max(1, int(char.height * scale))
-            resized = char.resize((w, h))
-            # center-ish position
-            frame.paste(resized, (80, max(0, 200 - int(50 * scale))), resized)
-            placeholder.image(frame)
-            time.sleep(0.05)
-
-        time.sleep(0.2)
-        placeholder.empty()
+    # --------------------------
+    # 演出アニメ（characters.py で事前に合成した WebP をブラウザで再生するだけ）
+    # --------------------------
+    def play_machine_roll(char_file, rarity_num, pull):
+        url = gacha_animation_url(char_file, rarity_num)
+        if not url.startswith("data:"):
+            # 同じ URL の画像はブラウザがアニメの再生状態を共有するので、引くたびに URL を変えて最初から再生させる
+            url += f"?pull={pull}"
+        st.markdown(
+            f'<img src="{url}" style="width:100%; max-width:512px;">',
+            unsafe_allow_html=True,
+        )
 
     # --------------------------
     # ガチャ実行（mode -> 'anim' にして rerun）
@@ -309,11 +186,10 @@ with tab_gacha:
             st.warning("コインがありません！")
             return
 
-        chars = load_characters()
         rarity_num = pick_rarity()
         rarity_name = RARITY_LABELS[rarity_num]
 
-        char_file = get_character(rarity_num, chars)
+        char_file = catalog.pick(rarity_num)
         # if no char found, abort gracefully
         if char_file is None:
             st.error("キャラクターが見つかりません。")
@@ -322,7 +198,9 @@ with tab_gacha:
         egg_file = RARITY_EGG[rarity_num]
         break_file = RARITY_BREAK[rarity_num]
 
+        st.session_state.gacha_pulls += 1
         st.session_state.result = {
+            "pull": st.session_state.gacha_pulls,
             "rarity_num": rarity_num,
             "rarity_name": rarity_name,
             "egg": egg_file,
@@ -352,18 +230,13 @@ with tab_gacha:
                 st.rerun()
                 return
 
-            egg_img = f"{EGG_PATH}/{data['egg']}"
-            break_img = f"{EGG_PATH}/{data['break']}"
-            char_img = f"{CHAR_PATH}/{data['char']}"
-
             st.markdown("## 🎉 ガチャ結果！")
-            # play animation (blocking until done)
-            play_machine_roll(egg_img, break_img, char_img)
-
-            # after animation, switch to result display
+            # アニメはブラウザで再生されるので待たない。結果はアニメが終わる頃に表示する
+            play_machine_roll(data["char"], data["rarity_num"], data.get("pull", 0))
+            reveal_delay = GACHA_ANIM_MS
             st.session_state.mode = "result"
-            st.rerun()
-            return
+        else:
+            reveal_delay = 0
 
         # RESULT MODE
         if st.session_state.mode == "result":
@@ -380,14 +253,25 @@ with tab_gacha:
                 rarity=data["rarity_name"]
             )
 
-            st.markdown(f"## 【{data['rarity_name']}】")
-            # show char image (fallback safe)
-            char_path = f"{CHAR_PATH}/{data['char']}"
-            if os.path.exists(char_path):
-                st.image(char_path, width=300)
-            else:
-                st.write(f"(画像が見つかりません：{data['char']})")
-            st.markdown(f"**{data['char']}**")
+            st.markdown(
+                f"""
+                <style>
+                @keyframes gachaReveal {{ from {{ opacity: 0; }} to {{ opacity: 1; }} }}
+                .gacha-reveal {{ animation: gachaReveal 0.4s ease {reveal_delay}ms both; }}
+                </style>
+                <div class="gacha-reveal">
+                    <h2>【{data['rarity_name']}】</h2>
+                    <p><b>{data['char']}</b></p>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            # アニメの最後のフレームにキャラが出ているので、画像はアニメがないときだけ
+            if not reveal_delay:
+                if data["char"] in catalog:
+                    st.image(thumbnail_path(catalog.path(data["char"]), GACHA_THUMB), width=300)
+                else:
+                    st.write(f"(画像が見つかりません：{data['char']})")
 
             col1, col2 = st.columns(2)
             with col1:
@@ -413,7 +297,7 @@ with tab_gacha:
         machine_col, right_col = st.columns([2, 1])
         with machine_col:
             if os.path.exists(f"{BASE}/gacha_machine.png"):
-                st.image(f"{BASE}/gacha_machine.png", width="stretch")
+                st.image(optimized_path(f"{BASE}/gacha_machine.png"), width="stretch")
             else:
                 st.write("（ガチャマシーン画像がありません）")
 
@@ -428,7 +312,7 @@ with tab_gacha:
                 egg_col, text_col = st.columns([1, 2])
                 with egg_col:
                     if os.path.exists(egg_file):
-                        st.image(egg_file, width=60)
+                        st.image(optimized_path(egg_file), width=60)
                     else:
                         st.write("（画像なし）")
                 with text_col:
@@ -464,7 +348,6 @@ with tab_gacha:
 with tab_chara:
 
     import os
-    import base64
     import streamlit as st
 
     current_chara = st.session_state.get("current_chara")
@@ -482,23 +365,9 @@ with tab_chara:
     """, unsafe_allow_html=True)
 
     # --------------------------
-    # Base64変換
+    # キャラ一覧（キャラ図鑑のインデックス）
     # --------------------------
-    def img_to_base64(path):
-        with open(path, "rb") as f:
-            return base64.b64encode(f.read()).decode()
-
-    # --------------------------
-    # キャラ一覧（フォルダ基準）
-    # --------------------------
-    if not os.path.exists(CHAR_PATH):
-        st.error("キャラ画像フォルダが存在しません")
-        st.stop()
-
-    all_characters = sorted([
-        f for f in os.listdir(CHAR_PATH)
-        if f.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))
-    ])
+    all_characters = catalog.names
 
     if not all_characters:
         st.warning("キャラ画像がありません")
@@ -565,16 +434,6 @@ with tab_chara:
 
 
 
-    # --------------------------
-    # レアリティ判定
-    # --------------------------
-    def get_rarity_from_filename(filename):
-        try:
-            num = int(filename[4])  # starX_
-        except:
-            return "N"
-        return {1: "N", 2: "R", 3: "SR", 4: "UR", 5: "LEGEND"}.get(num, "N")
-
     # --------------------------
     # レアリティ別デザイン
     # --------------------------
@@ -620,10 +479,9 @@ with tab_chara:
         col = cols[idx % 5]
 
         with col:
-            img_path = f"{CHAR_PATH}/{filename}"
-            b64 = img_to_base64(img_path)
+            img_url = thumbnail_url(catalog.path(filename), GRID_THUMB)
 
-            rarity = get_rarity_from_filename(filename)
+            rarity = catalog.label(filename)
             style = RARITY_STYLE[rarity]
             is_owned = filename in owned_set
             is_current = (filename == current_chara)
@@ -664,7 +522,7 @@ with tab_chara:
                         background:{bg_color};
                         border-radius:10px;
                     ">
-                    <img src="data:image/png;base64,{b64}"
+                    <img src="{img_url}"
                         style="
                             max-width:100%;
                             max-height:100%;
@@ -705,26 +563,8 @@ with tab_chara:
 # ==========================
 with tab_map:
 
-    import base64
     import streamlit as st
 
-    def img_to_base64(path):
-        with open(path, "rb") as f:
-            return base64.b64encode(f.read()).decode()
-    
-    def ensure_map_progress(user_id):
-        conn = get_conn()
-        c = conn.cursor()
-
-        c.execute("""
-            INSERT OR IGNORE INTO user_map_progress (
-                user_id, map_pos, current_chara, move_count, updated_at
-            ) VALUES (?, 0, '', 0, ?)
-        """, (user_id, datetime.now().isoformat()))
-
-        conn.commit()
-        conn.close()
-
     ensure_map_progress(user_id)
 
     st.title("🚶‍♂️ 冒険")
@@ -779,7 +619,7 @@ with tab_map:
     }
 
     COIN_PATH = "assets/images/coin.png"
-    coin64 = img_to_base64(COIN_PATH)
+    coin_url = asset_url(COIN_PATH)
 
     if "current_map" not in st.session_state:
         st.session_state.current_map = "grass"
@@ -798,8 +638,8 @@ with tab_map:
 
     move_count = get_move_count(user_id)
 
-    bg64 = img_to_base64(f"assets/images/maps/{current_map['img']}")
-    char64 = img_to_base64(f"assets/images/characters/{current_chara}")
+    bg_url = asset_url(f"assets/images/maps/{current_map['img']}")
+    char_url = thumbnail_url(f"assets/images/characters/{current_chara}", GRID_THUMB)
 
     # --------------------------
     # HTML生成
@@ -814,7 +654,7 @@ with tab_map:
 
     coins_html = "".join([
         f"""
-        <img src="data:image/png;base64,{coin64}"
+        <img src="{coin_url}"
             class="coin"
             style="
                 left:{node_positions[i][0]}%;
@@ -839,7 +679,7 @@ with tab_map:
             max-width:1400px;
             height:720px;
             margin:auto;
-            background-image:url('data:image/png;base64,{bg64}');
+            background-image:url('{bg_url}');
             background-size:cover;
             background-position:center;
             border:4px solid #3a2f1b;
@@ -895,7 +735,7 @@ with tab_map:
         <div id="map-area">
             {nodes_html}
             {coins_html}
-        <img src="data:image/png;base64,{char64}"
+        <img src="{char_url}"
             class="chara"
             style="left:{char_x}%; top:{char_y - 6}%;">
         </div>
@@ -2,13 +2,12 @@ import streamlit as st
 import os
 import time
 import random
-import base64
-from datetime import datetime, timedelta
 import streamlit.components.v1 as components
 from utils import load_css, calc_nutrient_targets
-import json
+from asset_store import asset_url, optimized_path
 
-from db import load_meals, load_user_badges, save_user_badge, get_user_profile
+from db import load_user_badges, save_user_badge, get_user_profile
+from badges import BADGES, get_badge_progress
 from components.render_sidebar import render_sidebar
 
 load_css("styles.css")
@@ -24,14 +23,11 @@ def play_sound_hidden(sound_path):
     if not os.path.exists(sound_path):
         return
 
-    with open(sound_path, "rb") as f:
-        data = f.read()
-
-    b64 = base64.b64encode(data).decode()
+    sound_url = asset_url(sound_path)
     st.markdown(
         f"""
         <audio autoplay style="display:none;">
-            <source src="data:audio/mp3;base64,{b64}" type="audio/mp3">
+            <source src="{sound_url}" type="audio/mp3">
         </audio>
         """,
         unsafe_allow_html=True
@@ -82,84 +78,6 @@ def play_gif_once(placeholder, gif_path, png_path, width=120, duration=1.4):
         placeholder.image(png_path, width=width)
 
 
-# =========================================================
-# 🔥 バッジの条件判定ロジック
-# =========================================================
-
-def get_streak(user_id):
-    """連続日数（食事登録）"""
-    meals = load_meals(user_id)
-    dates = sorted({m["date"] for m in meals}, reverse=True)
-
-    if not dates:
-        return 0
-
-    streak = 1
-    today = datetime.now().date()
-
-    for i in range(1, len(dates)):
-        d1 = datetime.fromisoformat(dates[i-1]).date()
-        d2 = datetime.fromisoformat(dates[i]).date()
-        if (d1 - d2).days == 1:
-            streak += 1
-        else:
-            break
-
-    return streak
-
-
-def get_morning_streak(user_id):
-    """朝食3日連続"""
-    meals = load_meals(user_id)
-    today = datetime.now().date()
-    streak = 0
-
-    for offset in range(3):
-        day = today - timedelta(days=offset)
-        exists = any(m["date"] == day.isoformat() and m["category"] == "朝食" for m in meals)
-        if exists:
-            streak += 1
-        else:
-            break
-
-    return streak
-
-
-from datetime import datetime, timedelta
-
-def get_no_late_streak(user_id):
-    """夜食（22〜3時）をしなかった日が何日連続しているか"""
-    meals = load_meals(user_id)
-    today = datetime.now().date()
-    streak = 0
-
-    for offset in range(7):
-        day = today - timedelta(days=offset)
-
-        day_meals = [
-            m for m in meals
-            if m["date"] == day.isoformat()
-        ]
-
-        # ❌ 食事記録が1件もない日は継続不可
-        if not day_meals:
-            break
-
-        has_late = False
-        for m in day_meals:
-            hour = int(m["time"].split(":")[0])
-            if hour >= 22 or hour < 3:
-                has_late = True
-                break
-
-        # 夜食してたら終了
-        if has_late:
-            break
-
-        streak += 1
-
-    return streak
-
 # =========================================================
 # 🔐 ユーザーID 必須
 # =========================================================
@@ -172,52 +90,11 @@ user_id = st.session_state["user_id"]
 earned = load_user_badges(user_id)
 
 # =========================================================
-# ⭐ 実績バッジリスト（このまま運用）
+# 🔥 バッジ進捗（食事保存時に更新済みのものを読むだけ）
 # =========================================================
-BADGES = [
-    {
-        "id": "first",
-        "req": 1,
-        "title": "はじめの一歩",
-        "desc": "初めて食事を記録する",
-        "func": lambda uid: 1 if load_meals(uid) else 0,
-    },
-    {
-        "id": "3days",
-        "req": 3,
-        "title": "三日坊主卒業",
-        "desc": "食事記録を3日連続で続ける",
-        "func": get_streak,
-    },
-    {
-        "id": "7days",
-        "req": 7,
-        "title": "習慣化の兆し",
-        "desc": "食事記録を7日連続で続ける",
-        "func": get_streak,
-    },
-    {
-        "id": "30days",
-        "req": 30,
-        "title": "日常茶飯事",
-        "desc": "食事記録を30日連続で続ける",
-        "func": get_streak,
-    },
-    {
-        "id": "early_morning",
-        "req": 3,
-        "title": "1日の準備",
-        "desc": "朝食を3日連続で続ける",
-        "func": get_morning_streak,
-    },
-    {
-        "id": "prohabit_late_night_snack",
-        "req": 7,
-        "title": "健康的習慣",
-        "desc": "夜食を7日間しなかった",
-        "func": get_no_late_streak,
-    },
-]
+profile = get_user_profile(user_id)
+targets = calc_nutrient_targets(profile) if profile else None
+progresses = get_badge_progress(user_id, targets)
 
 # =========================================================
 # 🏆 バッジ表示
@@ -229,12 +106,11 @@ for i, badge in enumerate(BADGES):
     req = badge["req"]
     title = badge["title"]
     desc = badge["desc"]
-    func = badge["func"]
 
     col = cols[i % 5]
 
     # 進捗
-    progress = func(user_id)
+    progress = progresses[badge_id]
     ratio = min(progress / req, 1)
     is_earned = badge_id in earned
 
@@ -279,9 +155,9 @@ for i, badge in enumerate(BADGES):
             img_ph = st.empty()   # ← ここが超重要
 
             if is_earned:
-                img_ph.image(color, width=110)
+                img_ph.image(optimized_path(color), width=110)
             else:
-                img_ph.image(color if progress >= req else gray, width=110)
+                img_ph.image(optimized_path(color if progress >= req else gray), width=110)
 
         # まずカードHTMLを全部描画
         st.markdown(f"""
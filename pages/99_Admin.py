@@ -1,6 +1,10 @@
 import streamlit as st
-import sqlite3
 import pandas as pd
+from db import connection
+from utils import llm_metrics, analysis_flight, llm, llm_scheduler, GeminiModel
+from asset_store import cache_stats, load_manifest
+from foods import get_food_index, reload_food_index
+from characters import RARITY_LABELS, get_catalog, reload_catalog
 from components.render_sidebar import render_sidebar
 
 ADMIN_PASSWORD = "admin123"
@@ -30,32 +34,75 @@ if not st.session_state.is_admin:
 # -----------------------------
 st.title("管理者ダッシュボード")
 
-conn = sqlite3.connect("nutrition.db")
-cursor = conn.cursor()
+with connection() as conn:
+    # SQL入力欄
+    st.subheader("SQL実行")
+    sql_query = st.text_area("SQLを入力してください（例: SELECT * FROM users;）", height=100)
 
-# SQL入力欄
-st.subheader("SQL実行")
-sql_query = st.text_area("SQLを入力してください（例: SELECT * FROM users;）", height=100)
+    if st.button("実行"):
+        try:
+            # SQL実行
+            df = pd.read_sql(sql_query, conn)
+            st.success("SQL実行成功")
+            st.dataframe(df)
+        except Exception as e:
+            st.error(f"SQL実行エラー: {e}")
 
-if st.button("実行"):
-    try:
-        # SQL実行
-        df = pd.read_sql(sql_query, conn)
-        st.success("SQL実行成功")
+    # 1. DB内のテーブル一覧を取得
+    tables = [t[0] for t in conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()]
+
+    st.write(f"テーブル一覧: {tables}")
+
+    # 2. 全テーブルのデータを表示＆ダウンロード
+    all_data = {}
+    for table in tables:
+        st.subheader(f"{table} テーブル")
+        df = pd.read_sql(f"SELECT * FROM {table}", conn)
         st.dataframe(df)
-    except Exception as e:
-        st.error(f"SQL実行エラー: {e}")
-
-# 1. DB内のテーブル一覧を取得
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-tables = [t[0] for t in cursor.fetchall()]
-
-st.write(f"テーブル一覧: {tables}")
-
-# 2. 全テーブルのデータを表示＆ダウンロード
-all_data = {}
-for table in tables:
-    st.subheader(f"{table} テーブル")
-    df = pd.read_sql(f"SELECT * FROM {table}", conn)
-    st.dataframe(df)
-    all_data[table] = df
\ No newline at end of file
+        all_data[table] = df
+
+# -----------------------------
+# AI呼び出しのレイテンシ（このプロセスの直近の値）
+# -----------------------------
+st.subheader("AI呼び出しメトリクス")
+metrics = llm_metrics.summary()
+if metrics:
+    st.dataframe(pd.DataFrame.from_dict(metrics, orient="index"))
+else:
+    st.write("（まだ呼び出しがありません）")
+
+# 同時に来た同じ栄養解析の相乗り状況（coalesced が AI 呼び出しを省けた回数）
+st.write("栄養解析の相乗り:", analysis_flight.summary())
+# セッションをまたいだ食品のまとめ問い合わせ（avg_batch が1回のプロンプトあたりの食品数）
+if isinstance(llm, GeminiModel):
+    st.write("栄養解析のバッチ:", llm.food_batcher.summary())
+# API 利用枠の待ち行列（waits は優先度ごと。0 = 食事の解析, 1 = アドバイス・献立）
+st.write("AI呼び出しの待ち行列:", llm_scheduler.summary())
+
+# 画像・音声の base64 キャッシュ（このプロセス）
+st.subheader("アセットキャッシュ")
+st.write(cache_stats())
+# scripts/optimize_assets.py build の結果（空なら未実行で、元のファイルをそのまま配信している）
+manifest = load_manifest()
+original = sum(e["bytes"] for e in manifest.values())
+optimized = sum(
+    e["variants"][e["best"]]["bytes"] if e["best"] else e["bytes"] for e in manifest.values()
+)
+st.write("最適化済みの画像:", {"files": len(manifest), "original_bytes": original, "served_bytes": optimized})
+
+# -----------------------------
+# 読み込み済みのインデックス（python foods.py import やキャラ画像の追加の後にここで読み直す）
+# -----------------------------
+st.subheader("インデックスの再読み込み")
+if st.button("食品成分表を読み直す"):
+    reload_food_index()
+    st.success("食品成分表を読み直しました")
+st.write("食品成分表:", {"foods": len(get_food_index().foods)})
+if st.button("キャラ図鑑を読み直す"):
+    reload_catalog()
+    st.success("キャラ図鑑を読み直しました")
+catalog = get_catalog()
+st.write("キャラ図鑑:", {
+    "characters": len(catalog),
+    **{label: len(catalog.pools[num]) for num, label in RARITY_LABELS.items()},
+})
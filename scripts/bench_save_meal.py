@@ -0,0 +1,74 @@
+# scripts/bench_save_meal.py
+#   食事の解析〜保存（ジョブ・DB保存・バッジ更新まで）をまとめて流して時間を測る
+#   既定では LLM_PROVIDER=local（通信なし・毎回同じ結果）で、DB は一時ディレクトリのコピーを使う
+#   python scripts/bench_save_meal.py [--users 20] [--meals 5] [--latency-ms 300]
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FOODS = ["カレーライス", "鮭の塩焼き", "ごはん", "味噌汁", "唐揚げ", "サラダ", "ヨーグルト", "食パン"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="食事保存のベンチマーク")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--meals", type=int, default=5, help="1ユーザーあたりの食事数")
+    parser.add_argument("--latency-ms", type=float, default=300, help="local プロバイダの待ち時間")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LLM_PROVIDER", "local")
+    os.environ.setdefault("LOCAL_LLM_LATENCY_MS", str(args.latency_ms))
+
+    # 本番の DB を汚さないようにコピーの上で動かす（DB_NAME はカレントディレクトリ基準）
+    workdir = tempfile.mkdtemp(prefix="bench_save_meal_")
+    shutil.copy(os.path.join(ROOT, "nutrition.db"), workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    import jobs  # 食事保存時のバッジ更新も含めて測る（jobs がフックを登録する）
+    from utils import llm, llm_metrics
+
+    date = time.strftime("%Y-%m-%d")
+    submitted = {}
+    start = time.perf_counter()
+    for n in range(args.meals):
+        for u in range(args.users):
+            user_id = 100000 + u
+            food_list = [
+                {"food": FOODS[(u + n + k) % len(FOODS)], "grams": 100 + 10 * k} for k in range(3)
+            ]
+            job_id = jobs.submit(
+                user_id, "analyze_food_multi",
+                food_list=food_list,
+                meal={"user_id": user_id, "date": date, "category": "昼食"},
+            )
+            submitted[job_id] = time.perf_counter()
+
+    latencies, errors = [], 0
+    pending = set(submitted)
+    while pending:
+        for job_id in list(pending):
+            job = jobs.get(job_id)
+            if job["status"] in ("done", "error"):
+                latencies.append(time.perf_counter() - submitted[job_id])
+                errors += job["status"] == "error"
+                pending.discard(job_id)
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"プロバイダ: {llm.name}  ジョブ数: {len(latencies)}  エラー: {errors}")
+    print(f"合計 {elapsed:.2f}s  スループット {len(latencies) / elapsed:.1f} 件/s")
+    print(
+        f"完了までの時間 p50 {statistics.median(latencies) * 1000:.0f}ms"
+        f"  p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms"
+    )
+    for label, stat in llm_metrics.summary().items():
+        print(f"  {label}: {stat}")
+
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,54 @@
+# scripts/bench_startup.py
+#   起動時の import にかかる時間を測る（毎回新しいプロセスで計測）
+#   python scripts/bench_startup.py [--runs 10]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 名前, 計測前に読み込んでおくもの, 計測するコード
+TARGETS = [
+    ("import utils（AIを使わないページ）", "", "import utils"),
+    ("import badges", "", "import badges"),
+    ("import jobs", "", "import jobs"),
+    ("最初のAIクライアント作成", "import utils", "utils.genai_client.get()"),
+]
+
+SNIPPET = """
+import sys, time
+{setup}
+t = time.perf_counter()
+{code}
+print(time.perf_counter() - t, "google.genai" in sys.modules)
+"""
+
+
+def measure(setup, code, runs):
+    env = dict(os.environ)
+    env.setdefault("GENAI_API_KEY", "dummy")  # クライアント作成だけなので通信はしない
+    times, loaded = [], False
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", SNIPPET.format(setup=setup, code=code)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        times.append(float(out[-2]))
+        loaded = out[-1] == "True"
+    return times, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'対象':<36}{'中央値':>10}{'最小':>10}  SDK読込")
+    for name, setup, code in TARGETS:
+        times, loaded = measure(setup, code, args.runs)
+        print(
+            f"{name:<36}{statistics.median(times) * 1000:>8.0f}ms{min(times) * 1000:>8.0f}ms"
+            f"  {'あり' if loaded else 'なし'}"
+        )
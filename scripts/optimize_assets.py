@@ -0,0 +1,236 @@
+# scripts/optimize_assets.py
+#   assets/ の画像を配信用に圧縮・変換して static/optimized/ とマニフェストを作る
+#     python scripts/optimize_assets.py build [--force]
+#   各ページが1回の表示で転送する画像・音声のバイト数が予算内か確かめる（超えたら終了コード 1）
+#     python scripts/optimize_assets.py check-budget
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)   # アセットのパスはリポジトリ直下からの相対パス
+
+from PIL import Image, features  # noqa: E402
+
+import asset_store  # noqa: E402
+from characters import get_catalog  # noqa: E402
+from asset_store import (  # noqa: E402
+    GACHA_THUMB, GRID_THUMB, MANIFEST_NAME, MOBILE_WIDTH, OPTIMIZED_DIR, PORTRAIT_THUMB, STATIC_DIR,
+    file_hash, optimized_path, thumbnail_path,
+)
+
+ASSET_DIRS = ["assets/images"]
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")   # GIF はアニメーションを保つためそのまま配信する
+WEBP_QUALITY = 85
+AVIF_QUALITY = 60
+HAS_AVIF = features.check("avif")   # Pillow 11.3 未満や libavif なしのビルドでは作らない
+
+OUT_DIR = os.path.join(STATIC_DIR, OPTIMIZED_DIR)
+MANIFEST_PATH = os.path.join(OUT_DIR, MANIFEST_NAME)
+
+
+# -----------------------------
+# 変換
+# -----------------------------
+def _encode(img, fmt, **options):
+    buf = io.BytesIO()
+    img.save(buf, fmt, **options)
+    return buf.getvalue()
+
+
+def _variants(path):
+    """{variant: (拡張子, バイト列)}。png は可逆の再圧縮で、元より小さくならなければ作らない"""
+    with Image.open(path) as img:
+        img.load()
+        src_format = img.format
+        size = img.size
+        rgba = img if img.mode in ("RGB", "RGBA") else img.convert("RGBA")
+
+        out = {"webp": (".webp", _encode(rgba, "WEBP", quality=WEBP_QUALITY))}
+        if HAS_AVIF:
+            out["avif"] = (".avif", _encode(rgba, "AVIF", quality=AVIF_QUALITY))
+        if src_format == "PNG":
+            png = _encode(img, "PNG", optimize=True)
+            if len(png) < os.path.getsize(path):
+                out["png"] = (".png", png)
+        if size[0] > MOBILE_WIDTH:
+            small = rgba.resize(
+                (MOBILE_WIDTH, round(size[1] * MOBILE_WIDTH / size[0])), Image.LANCZOS
+            )
+            out["mobile"] = (".webp", _encode(small, "WEBP", quality=WEBP_QUALITY))
+    return size, out
+
+
+def _write(name, data):
+    dst = os.path.join(OUT_DIR, name)
+    if not os.path.exists(dst):
+        tmp = dst + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst)
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)["assets"]
+    except FileNotFoundError:
+        return {}
+
+
+def build(force=False):
+    """変換して manifest.json を書き直す。ハッシュが同じで出力が揃っているものは作り直さない"""
+    os.makedirs(OUT_DIR, exist_ok=True)
+    old = {} if force else load_manifest()
+    assets, built = {}, 0
+
+    for base in ASSET_DIRS:
+        for path in sorted(glob.glob(f"{base}/**/*", recursive=True)):
+            if not path.lower().endswith(IMAGE_EXTS):
+                continue
+            digest = file_hash(path)
+            entry = old.get(path)
+            if entry and entry["hash"] == digest and all(
+                os.path.exists(os.path.join(OUT_DIR, v["file"])) for v in entry["variants"].values()
+            ):
+                assets[path] = entry
+                continue
+
+            (width, height), variants = _variants(path)
+            stem = os.path.splitext(os.path.basename(path))[0]
+            entry = {
+                "hash": digest,
+                "bytes": os.path.getsize(path),
+                "width": width,
+                "height": height,
+                "variants": {},
+            }
+            for variant, (ext, data) in variants.items():
+                suffix = f".{MOBILE_WIDTH}" if variant == "mobile" else ""
+                name = f"{stem}.{digest}{suffix}{ext}"
+                _write(name, data)
+                entry["variants"][variant] = {"file": name, "bytes": len(data)}
+            # <img> / st.image でそのまま使う版（AVIF は対応していないブラウザがあるので候補にしない）
+            candidates = [v for v in ("png", "webp") if v in entry["variants"]]
+            best = min(candidates, key=lambda v: entry["variants"][v]["bytes"])
+            entry["best"] = best if entry["variants"][best]["bytes"] < entry["bytes"] else None
+            assets[path] = entry
+            built += 1
+
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"generated_at": time.strftime("%Y-%m-%d %H:%M:%S"), "assets": assets},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp, MANIFEST_PATH)
+
+    # マニフェストから外れた古い出力を消す
+    keep = {v["file"] for e in assets.values() for v in e["variants"].values()} | {MANIFEST_NAME}
+    for name in os.listdir(OUT_DIR):
+        if name not in keep:
+            os.remove(os.path.join(OUT_DIR, name))
+    return assets, built
+
+
+# -----------------------------
+# ページごとの転送量の予算
+#   ページを1回表示したときに読み込む画像・音声（タブの中身も全部描画される）
+#   (パス, サムネイルの大きさ or None) のリスト。ページのコードを変えたらここも合わせる
+# -----------------------------
+MAPS_IN_USE = ["grass.png", "desert.png", "snow.png"]   # 03 の MAP_ORDER
+
+
+def _largest(paths, px=None):
+    return [max(paths, key=lambda p: served_bytes(p, px))] if paths else []
+
+
+def page_assets():
+    chars = [c["path"] for c in get_catalog().characters.values()]
+    badges = [
+        p for p in sorted(glob.glob("assets/images/badges/*.png")) if not p.endswith("_gray.png")
+    ]
+    return {
+        "app.py": [("assets/images/title.png", None)],
+        "pages/02_MealInput.py": [("assets/images/loading_man.gif", None)],
+        "pages/03_RPG_and_Gacha.py": (
+            [(p, PORTRAIT_THUMB) for p in _largest(chars, PORTRAIT_THUMB)]      # 育成タブ
+            + [(p, GACHA_THUMB) for p in _largest(chars, GACHA_THUMB)]          # ガチャ結果
+            + [("assets/images/gacha_machine.png", None)]
+            + [(p, None) for p in sorted(glob.glob("assets/images/eggs/egg_*.png"))
+               if "break" not in p]
+            + [(p, GRID_THUMB) for p in chars]                                   # 図鑑
+            + [(p, None) for p in _largest([f"assets/images/maps/{m}" for m in MAPS_IN_USE])]
+            + [("assets/images/coin.png", None)]
+        ),
+        # 達成状況によって color / gray のどちらかなので、大きい方（color）で数える
+        "pages/04_Badges.py": (
+            [(p, None) for p in badges]
+            + [(p, None) for p in sorted(glob.glob("assets/images/badges/*_shine.gif"))]
+            + [("assets/sounds/rappa.mp3", None)]
+        ),
+    }
+
+
+BUDGETS = {   # バイト（最適化後の実測に 3 割ほどの余裕）
+    "app.py": 120_000,
+    "pages/02_MealInput.py": 80_000,
+    "pages/03_RPG_and_Gacha.py": 1_300_000,
+    "pages/04_Badges.py": 350_000,
+}
+
+
+def served_bytes(path, px=None):
+    """実際に配信されるファイルのバイト数（サムネイル / 最適化済みの版があればそちら）"""
+    if px:
+        return os.path.getsize(thumbnail_path(path, px))
+    return os.path.getsize(optimized_path(path))
+
+
+def check_budget():
+    """[(ページ, 転送量, 予算, 最適化前の転送量)]"""
+    rows = []
+    for page, items in page_assets().items():
+        served = sum(served_bytes(p, px) for p, px in items)
+        original = sum(os.path.getsize(p) for p, _ in items)
+        rows.append((page, served, BUDGETS[page], original))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="アセットの圧縮と転送量の予算チェック")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="圧縮・変換してマニフェストを書く")
+    p_build.add_argument("--force", action="store_true", help="すべて作り直す")
+    sub.add_parser("check-budget", help="ページごとの転送量が予算内か確かめる")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        assets, built = build(force=args.force)
+        before = sum(e["bytes"] for e in assets.values())
+        after = {}
+        for e in assets.values():
+            for variant, v in e["variants"].items():
+                after[variant] = after.get(variant, 0) + v["bytes"]
+        print(f"{len(assets)} 件（変換 {built} 件, {time.perf_counter() - start:.1f}s）元画像 {before / 1e6:.1f}MB")
+        if not HAS_AVIF:
+            print("  この Pillow は AVIF に対応していないため AVIF は作りませんでした")
+        for variant, total in sorted(after.items()):
+            print(f"  {variant:<7}{total / 1e6:>7.1f}MB")
+
+    elif args.command == "check-budget":
+        if not asset_store.load_manifest():
+            print("マニフェストがありません（最適化前のサイズで数えます）。先に build を実行してください",
+                  file=sys.stderr)
+        over = 0
+        print(f"{'ページ':<30}{'転送量':>10}{'予算':>10}{'最適化前':>10}")
+        for page, served, budget, original in check_budget():
+            mark = "" if served <= budget else "  予算超過"
+            over += served > budget
+            print(f"{page:<30}{served / 1e3:>8.0f}KB{budget / 1e3:>8.0f}KB{original / 1e3:>8.0f}KB{mark}")
+        sys.exit(1 if over else 0)
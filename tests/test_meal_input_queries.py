@@ -0,0 +1,69 @@
+# tests/test_meal_input_queries.py
+#   食事入力ページを1回表示したときに meals テーブルを読むクエリが1本だけか確かめる
+#     python -m pytest tests
+import datetime
+import os
+import queue
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PAGE = os.path.join(ROOT, "pages", "02_MealInput.py")
+USER_ID = 1
+
+
+@pytest.fixture
+def statements(tmp_path, monkeypatch):
+    """リポジトリの nutrition.db のコピーで動かし、プールの接続が実行した SQL を集める"""
+    shutil.copy(os.path.join(ROOT, "nutrition.db"), tmp_path)
+    monkeypatch.setenv("GENAI_API_KEY", "dummy")
+    monkeypatch.setenv("LLM_PROVIDER", "local")
+
+    import streamlit
+    monkeypatch.setattr(streamlit, "page_link", lambda *a, **k: None)   # AppTest ではページを登録しない
+
+    # db は import 時にカレントの nutrition.db を初期化するので、コピーのある場所で読み込む
+    monkeypatch.chdir(tmp_path)
+    import db
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "nutrition.db"))
+    monkeypatch.chdir(ROOT)   # ページは styles.css や assets/ をリポジトリ直下から読む
+
+    executed = []
+    connect = db._connect
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(executed.append)
+        return conn
+
+    monkeypatch.setattr(db, "_connect", traced_connect)
+    monkeypatch.setattr(db, "_pool", queue.LifoQueue(maxsize=db.POOL_SIZE))
+
+    today = datetime.date.today().isoformat()
+    nutrients = '[{"name": "カロリー", "value": 200, "unit": "kcal"}]'
+    for category in ("朝食", "昼食", "夕食"):
+        db.save_meal(USER_ID, today, category, "テスト飯", 100, nutrients, "")
+    return executed
+
+
+def test_meal_input_reads_meals_once(statements):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(PAGE, default_timeout=30)
+    at.session_state["user_id"] = USER_ID
+    at.run()   # 1回目はモジュールの読み込みや初期化のクエリが混ざるので数えない
+    assert not at.exception
+
+    statements.clear()
+    at.run()
+    assert not at.exception
+
+    meal_selects = [
+        sql for sql in statements
+        if sql.lstrip().upper().startswith("SELECT") and "FROM meals" in sql
+    ]
+    assert len(meal_selects) == 1, meal_selects
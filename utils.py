@@ -1,42 +1,402 @@
 import os
 import re
+import sys
 import json
-from typing import Dict, Any
+import time
+import hashlib
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import as_completed
+from types import SimpleNamespace
+from typing import Dict, Any, List
 import streamlit as st
+from pydantic import BaseModel, ValidationError
 
-# Google GenAI SDK
-try:
-    from google import genai
-except Exception as e:
-    raise RuntimeError("google-genai が必要です。pip install google-genai") from e
+from db import get_cached_nutrients, put_cached_nutrients
+from foods import lookup_nutrients
+from llm_runtime import SingleFlight, MicroBatcher, RateScheduler
 
-API_KEY = os.getenv("GENAI_API_KEY")
-if not API_KEY:
-    raise RuntimeError("環境変数 GENAI_API_KEY を設定してください")
+REQUEST_TIMEOUT_MS = 60_000                       # 1リクエストのタイムアウト
+MAX_RETRIES = 3                                   # 一時的なエラーの再試行回数
+RETRY_BACKOFF_SEC = 1.0                           # 1秒, 2秒, 4秒… と倍々で待つ
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
 
-client = genai.Client(api_key=API_KEY)
+# API の利用枠（1分あたり）。枠を超える呼び出しは失敗させずに順番待ちにする
+GENAI_RPM = int(os.getenv("GENAI_RPM", "15"))
+GENAI_TPM = int(os.getenv("GENAI_TPM", "1000000"))
+EXPECTED_OUTPUT_TOKENS = 512                      # 見積もりに足す出力分（実際の値は応答後に精算）
+
+# 優先度（小さいほど先）：食事の解析は画面で待っているので、アドバイス・献立より先に通す
+PRIORITY_MEAL = 0
+PRIORITY_BACKGROUND = 1
 
 # -----------------------------
-# Geminiモデルクラス
+# Google GenAI クライアント
+#   SDK の import・API キーの確認・クライアント作成は最初の AI 呼び出しまで遅らせる
+#   （AI を使わないページは SDK を読み込まず、キーがなくても起動できる）
 # -----------------------------
-class GeminiModel:
-    def __init__(self, model="gemini-2.0-flash"):
-        self.model = model
+class GenAIClientProvider:
+    def __init__(self, api_key_env="GENAI_API_KEY", timeout_ms=REQUEST_TIMEOUT_MS):
+        self.api_key_env = api_key_env
+        self.timeout_ms = timeout_ms
+        self._client = None
+        self._lock = threading.Lock()
 
-    # AI呼び出し
-    def generate_content(self, prompt: str) -> Any:
-        chat = client.chats.create(model=self.model)
-        return chat.send_message(prompt)
+    def get(self):
+        """プロセスで1つのクライアント（内部の HTTP 接続をキープアライブで使い回す）"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        from google import genai
+                        from google.genai import types
+                    except Exception as e:
+                        raise RuntimeError("google-genai が必要です。pip install google-genai") from e
 
-    # AI返答からJSON抽出
-    def extract_json(self, text: str) -> dict:
-        m = re.search(r"\{[\s\S]*\}", text)
-        if m:
+                    api_key = os.getenv(self.api_key_env)
+                    if not api_key:
+                        raise RuntimeError(f"環境変数 {self.api_key_env} を設定してください")
+
+                    self._client = genai.Client(
+                        api_key=api_key,
+                        http_options=types.HttpOptions(timeout=self.timeout_ms),
+                    )
+        return self._client
+
+
+genai_client = GenAIClientProvider()
+llm_scheduler = RateScheduler(GENAI_RPM, GENAI_TPM)
+
+
+def estimate_tokens(prompt: str) -> int:
+    """送信前のトークン数の見積もり（日本語はおよそ1文字1トークンとして多めに見る）"""
+    return len(prompt) + EXPECTED_OUTPUT_TOKENS
+
+
+def _used_tokens(res, estimated: int) -> int:
+    usage = getattr(res, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or estimated
+
+
+def _is_retryable(e: Exception) -> bool:
+    # SDK が読み込まれていなければ、その例外クラスのエラーも起きていない
+    genai_errors = sys.modules.get("google.genai.errors")
+    if genai_errors is not None and isinstance(e, genai_errors.APIError):
+        return e.code in RETRYABLE_STATUS
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(e, (httpx.TimeoutException, httpx.TransportError))
+
+
+# -----------------------------
+# AI呼び出しのレイテンシ計測
+# -----------------------------
+class LatencyMetrics:
+    def __init__(self, window=200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, label, seconds, ok=True, retries=0, first_chunk=None, tokens=0):
+        """first_chunk: ストリーミング時の最初の断片までの秒数 / tokens: 使ったトークン数（費用の目安）"""
+        with self._lock:
+            stat = self._stats.setdefault(label, {
+                "calls": 0, "errors": 0, "retries": 0, "tokens": 0,
+                "latencies": deque(maxlen=self.window), "first_chunks": deque(maxlen=self.window),
+            })
+            stat["calls"] += 1
+            stat["errors"] += 0 if ok else 1
+            stat["retries"] += retries
+            stat["tokens"] += tokens
+            stat["latencies"].append(seconds)
+            if first_chunk is not None:
+                stat["first_chunks"].append(first_chunk)
+
+    def summary(self):
+        """{label: {"calls", "errors", "retries", "tokens", "avg_ms", "p95_ms", "first_chunk_ms"}}（時間は直近 window 件の値）"""
+        with self._lock:
+            result = {}
+            for label, stat in self._stats.items():
+                lat = sorted(stat["latencies"])
+                first = stat["first_chunks"]
+                result[label] = {
+                    "calls": stat["calls"],
+                    "errors": stat["errors"],
+                    "retries": stat["retries"],
+                    "tokens": stat["tokens"],
+                    "avg_ms": round(sum(lat) / len(lat) * 1000, 1) if lat else 0,
+                    "p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000, 1) if lat else 0,
+                    "first_chunk_ms": round(sum(first) / len(first) * 1000, 1) if first else None,
+                }
+            return result
+
+
+llm_metrics = LatencyMetrics()
+
+
+class FakeClient:
+    """テスト・ローカル確認用の偽クライアント（genai.Client の models.generate_content(_stream) だけ真似る）
+
+    responder(prompt) の戻り値を応答の .text として返す。例外を投げればエラーを再現できる。
+    ストリーミングでは chunk_size 文字ずつに分けて返す。
+    """
+    def __init__(self, responder, latency=0.0, chunk_size=16):
+        self.models = self
+        self.responder = responder
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    def generate_content(self, model, contents, config=None):
+        self.calls.append(contents)
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(text=self.responder(contents))
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = self.generate_content(model, contents, config).text
+        for i in range(0, len(text), self.chunk_size):
+            yield SimpleNamespace(text=text[i:i + self.chunk_size])
+
+# 同じ食品リストの解析が同時に来たら AI 呼び出しを1回にまとめる（ユーザーをまたいで共有）
+analysis_flight = SingleFlight()
+
+# 栄養解析プロンプトの版。プロンプトを変えたら上げる（古いキャッシュを使わないため）
+NUTRITION_PROMPT_VERSION = 3
+
+# AI に問い合わせる食品はセッションをまたいでこの時間だけ集め、1回のプロンプトで解析する
+BATCH_WINDOW_SEC = 0.1
+BATCH_MAX_ITEMS = 20
+
+# -----------------------------
+# 栄養解析の応答スキーマ（AIにこの形の JSON だけを返させる）
+# -----------------------------
+class NutrientValue(BaseModel):
+    name: str
+    value: float
+    unit: str
+
+class FoodItem(BaseModel):
+    food: str
+    grams: float
+    nutrients: List[NutrientValue]
+
+class FoodAnalysis(BaseModel):
+    items: List[FoodItem]
+
+# SDK の型を使わず dict で渡す（import を遅らせるため）
+FOOD_ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": FoodAnalysis,
+}
+
+
+def extract_json(text: str) -> dict:
+    """AI返答から最初の JSON オブジェクトを取り出す（前後の説明文やコードフェンスは無視）。なければ {}"""
+    start = text.find("{")
+    while start != -1:
+        try:
+            obj, _ = json.JSONDecoder().raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            pass
+        start = text.find("{", start + 1)
+    return {}
+
+
+class JsonItemStream:
+    """{"items": [{...}, {...}]} 形式の応答を受信しながら読み、閉じた item から順に返す
+
+    文字列リテラルとエスケープを考慮して括弧の深さだけを数えるので、全文を待たずに
+    各 item を json.loads できる。
+    """
+    ITEM_DEPTH = 3  # ルートの { → items の [ → item の {
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = None
+
+    def feed(self, chunk: str) -> list:
+        """受け取った断片を読み進め、この断片で閉じた item の dict を返す"""
+        self.buf += chunk
+        done = []
+        for i in range(self.pos, len(self.buf)):
+            ch = self.buf[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth == self.ITEM_DEPTH and ch == "{":
+                    self.start = i
+            elif ch in "}]":
+                if self.depth == self.ITEM_DEPTH and ch == "}" and self.start is not None:
+                    try:
+                        done.append(json.loads(self.buf[self.start:i + 1]))
+                    except ValueError:
+                        pass
+                    self.start = None
+                self.depth -= 1
+        self.pos = len(self.buf)
+        return done
+
+# -----------------------------
+# 栄養解析キャッシュ用ヘルパー
+# -----------------------------
+def normalize_food_name(name: str) -> str:
+    """全角/半角・大小文字・空白の揺れをそろえる"""
+    name = unicodedata.normalize("NFKC", name).strip().lower()
+    return re.sub(r"\s+", " ", name)
+
+def nutrition_cache_key(food: str, model: str) -> str:
+    raw = f"{model}|{NUTRITION_PROMPT_VERSION}|{normalize_food_name(food)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def scale_nutrients(nutrients, factor: float):
+    """栄養素リストの値を factor 倍したコピーを返す"""
+    scaled = []
+    for n in nutrients:
+        try:
+            value = round(float(n.get("value", 0)) * factor, 2)
+        except (TypeError, ValueError):
+            value = 0
+        scaled.append({**n, "value": value})
+    return scaled
+
+def sum_nutrients(items):
+    """食品ごとの栄養素リストを合計して同じ形式のリストで返す"""
+    totals = {}
+    for item in items:
+        for n in item.get("nutrients", []):
+            entry = totals.setdefault(n.get("name"), {"name": n.get("name"), "value": 0, "unit": n.get("unit", "")})
             try:
-                return json.loads(m.group(0))
-            except Exception:
+                entry["value"] = round(entry["value"] + float(n.get("value", 0)), 2)
+            except (TypeError, ValueError):
                 pass
-        return {}
+    return list(totals.values())
+
+# -----------------------------
+# AI プロバイダの共通インターフェース
+#   ページやジョブはこのメソッドだけを使う（LLM_PROVIDER で実装を切り替える）
+# -----------------------------
+class LLMProvider(ABC):
+    name = ""
+
+    @abstractmethod
+    def analyze_food_multi(self, food_list, user_info=None, on_item=None):
+        """{"items": [...], "total": [...], "failed": [...]}。on_item(item) は食品ごとに確定した時点で呼ぶ"""
+
+    def generate_daily_advice(self, nutri_total: dict, nutrient_targets: dict) -> str:
+        return "".join(self.stream_daily_advice(nutri_total, nutrient_targets))
+
+    @abstractmethod
+    def stream_daily_advice(self, nutri_total: dict, nutrient_targets: dict):
+        """今日のアドバイスの text の断片を返すジェネレータ"""
+
+    def generate_tomorrow_menu(self, today_advice: str, nutri_total: dict, nutrient_targets: dict) -> str:
+        return "".join(self.stream_tomorrow_menu(today_advice, nutri_total, nutrient_targets))
+
+    @abstractmethod
+    def stream_tomorrow_menu(self, today_advice: str, nutri_total: dict, nutrient_targets: dict):
+        """明日の献立の text の断片を返すジェネレータ"""
+
+
+# -----------------------------
+# Geminiモデルクラス
+# -----------------------------
+class GeminiModel(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, model="gemini-2.0-flash", client=None, scheduler=None):
+        self.model = model
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else llm_scheduler
+        self.food_batcher = MicroBatcher(self._analyze_batch, window=BATCH_WINDOW_SEC, max_batch=BATCH_MAX_ITEMS)
+
+    # client を指定しなければ、最初の呼び出しで共有のクライアントを作る
+    @property
+    def client(self):
+        return self._client if self._client is not None else genai_client.get()
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    # 一時的なエラーは指数バックオフで再試行する。(戻り値, 再試行回数) を返す
+    def _with_retries(self, label, start, func):
+        retries = 0
+        while True:
+            try:
+                return func(), retries
+            except Exception as e:
+                if retries >= MAX_RETRIES or not _is_retryable(e):
+                    llm_metrics.record(label, time.perf_counter() - start, ok=False, retries=retries)
+                    raise
+                time.sleep(RETRY_BACKOFF_SEC * (2 ** retries))
+                retries += 1
+
+    # AI呼び出し（会話状態を持たない単発リクエスト）
+    #   送信（再試行を含む）のたびにスケジューラの枠を取ってから呼ぶ
+    def generate_content(self, prompt: str, label: str = "generate_content", config=None,
+                         priority: int = PRIORITY_BACKGROUND) -> Any:
+        start = time.perf_counter()
+        label = f"{self.name}:{label}"
+        estimated = estimate_tokens(prompt)
+
+        def call():
+            self.scheduler.acquire(priority, estimated)
+            return self.client.models.generate_content(model=self.model, contents=prompt, config=config)
+
+        res, retries = self._with_retries(label, start, call)
+        used = _used_tokens(res, estimated)
+        self.scheduler.settle(estimated, used)
+        llm_metrics.record(label, time.perf_counter() - start, retries=retries, tokens=used)
+        return res
+
+    # AI呼び出し（ストリーミング）。text の断片を届いた順に返すジェネレータ
+    #   再試行するのは最初の断片が届くまで（途中まで返した後はやり直さない）
+    def generate_content_stream(self, prompt: str, label: str = "generate_content_stream", config=None,
+                                priority: int = PRIORITY_BACKGROUND):
+        start = time.perf_counter()
+        label = f"{self.name}:{label}"
+        estimated = estimate_tokens(prompt)
+
+        def open_stream():
+            self.scheduler.acquire(priority, estimated)
+            stream = self.client.models.generate_content_stream(model=self.model, contents=prompt, config=config)
+            return stream, next(stream, None)
+
+        (stream, first), retries = self._with_retries(label, start, open_stream)
+        first_chunk = time.perf_counter() - start
+        last = first
+        ok = False
+        try:
+            if first is not None and first.text:
+                yield first.text
+            for chunk in stream:
+                last = chunk
+                if chunk.text:
+                    yield chunk.text
+            ok = True
+        finally:
+            # 使用トークン数は最後の断片に入っている
+            used = _used_tokens(last, estimated)
+            self.scheduler.settle(estimated, used)
+            llm_metrics.record(
+                label, time.perf_counter() - start, ok=ok, retries=retries, first_chunk=first_chunk, tokens=used
+            )
 
     # 食品判定
     def is_food_item(self, name: str) -> bool:
@@ -44,16 +404,11 @@ class GeminiModel:
         次の単語 "{name}" は食品または飲み物ですか？
         JSON形式で返してください: {{ "is_food": true }} または {{ "is_food": false }}
         """
-        chat = client.chats.create(model=self.model)
-        res = chat.send_message(prompt)
+        res = self.generate_content(prompt, label="is_food_item", priority=PRIORITY_MEAL)
         reply = res.text.strip()
-        m = re.search(r"\{[\s\S]*\}", reply)
-        if m:
-            try:
-                data = json.loads(m.group(0))
-                return bool(data.get("is_food", False))
-            except Exception:
-                return "true" in reply.lower()
+        data = extract_json(reply)
+        if "is_food" in data:
+            return bool(data["is_food"])
         return "true" in reply.lower()
 
     # 栄養分析
@@ -83,24 +438,27 @@ class GeminiModel:
         ユーザー情報:
         {ui}
         """
-        chat = client.chats.create(model=self.model)
-        res = chat.send_message(prompt)
+        res = self.generate_content(prompt, label="analyze_food", priority=PRIORITY_MEAL)
         reply = res.text.strip()
-        m = re.search(r"\{[\s\S]*\}", reply)
-        if m:
-            try:
-                return json.loads(m.group(0))
-            except Exception:
-                pass
-        return {"nutrients": [], "advice": reply}
+        return extract_json(reply) or {"nutrients": [], "advice": reply}
     
         # 今日のアドバイス生成
     def generate_daily_advice(self, nutri_total: dict, nutrient_targets: dict) -> str:
         """
         栄養データと目標値から、Gemini による総括アドバイスを生成するメソッド
         """
+        res = self.generate_content(self._daily_advice_prompt(nutri_total, nutrient_targets), label="daily_advice")
+        return res.text
+
+    def stream_daily_advice(self, nutri_total: dict, nutrient_targets: dict):
+        """generate_daily_advice のストリーミング版（text の断片を返すジェネレータ）"""
+        return self.generate_content_stream(
+            self._daily_advice_prompt(nutri_total, nutrient_targets), label="daily_advice_stream"
+        )
 
-        advice_prompt = f"""
+    @staticmethod
+    def _daily_advice_prompt(nutri_total: dict, nutrient_targets: dict) -> str:
+        return f"""
         あなたは管理栄養士です。
 
         ユーザーが今日摂取した栄養素の合計:
@@ -116,16 +474,25 @@ class GeminiModel:
         3. 明日の行動アドバイス
         """
 
-        res = self.generate_content(advice_prompt)
-        return res.text
-
         #明日の献立
     def generate_tomorrow_menu(self, today_advice: str, nutri_total: dict, nutrient_targets: dict) -> str:
         """
         今日のアドバイスを基に材料込みの明日の献立（朝・昼・夜）を生成する
         """
+        res = self.generate_content(
+            self._tomorrow_menu_prompt(today_advice, nutri_total, nutrient_targets), label="tomorrow_menu"
+        )
+        return res.text
+
+    def stream_tomorrow_menu(self, today_advice: str, nutri_total: dict, nutrient_targets: dict):
+        """generate_tomorrow_menu のストリーミング版（text の断片を返すジェネレータ）"""
+        return self.generate_content_stream(
+            self._tomorrow_menu_prompt(today_advice, nutri_total, nutrient_targets), label="tomorrow_menu_stream"
+        )
 
-        menu_prompt = f"""
+    @staticmethod
+    def _tomorrow_menu_prompt(today_advice: str, nutri_total: dict, nutrient_targets: dict) -> str:
+        return f"""
         あなたは管理栄養士です。
 
         --- 今日の総括アドバイス ---
@@ -166,68 +533,173 @@ class GeminiModel:
             …
 
         """
-
-        res = self.generate_content(menu_prompt)
-        return res.text
     
-        # 複数食品まとめて解析
-    def analyze_food_multi(self, food_list, user_info=None):
+        # 複数食品まとめて解析（成分表 → キャッシュ → AI の順に解決）
+    def analyze_food_multi(self, food_list, user_info=None, on_item=None):
+        """{"items": [...], "total": [...], "failed": [解析できなかった食品名]} を返す
 
-        ui = ""
-        if user_info:
-            ui = "\n".join(f"{k}: {v}" for k, v in user_info.items())
+        on_item(item) は食品ごとに栄養素が確定した時点で呼ばれる（AI の分はストリームで item が閉じるたび）。
+        同じ食品・グラム数のリストが解析中なら、その結果を待って共有する。
+        user_info は互換のために受け取るだけ（栄養素の推定はユーザーによらず、他のユーザーの分とまとめて問い合わせる）。
+        """
+        key = (self.model,) + tuple((normalize_food_name(f["food"]), float(f["grams"])) for f in food_list)
+        result, shared = analysis_flight.do(key, lambda: self._analyze_food_multi(food_list, on_item))
+        if not shared:
+            return result
+
+        # 相乗りした側：食品名は自分の入力の表記に戻す
+        names = {normalize_food_name(f["food"]): f["food"] for f in food_list}
+        items = [{**item, "food": names.get(normalize_food_name(item["food"]), item["food"])} for item in result["items"]]
+        if on_item:
+            for item in items:
+                on_item(item)
+        failed = [names.get(normalize_food_name(name), name) for name in result["failed"]]
+        return {**result, "items": items, "failed": failed}
+
+    def _analyze_food_multi(self, food_list, on_item=None):
+        items = [None] * len(food_list)
+
+        def resolve(i, item):
+            items[i] = item
+            if on_item:
+                on_item(item)
+
+        for i, f in enumerate(food_list):
+            nutrients = lookup_nutrients(f["food"], f["grams"])
+            if nutrients is not None:
+                resolve(i, {"food": f["food"], "grams": f["grams"], "nutrients": nutrients})
+
+        keys = [nutrition_cache_key(f["food"], self.model) for f in food_list]
+        cached = get_cached_nutrients([keys[i] for i, item in enumerate(items) if item is None])
+
+        misses = []
+        for i, f in enumerate(food_list):
+            if items[i] is not None:
+                continue
+            per100 = cached.get(keys[i])
+            if per100 is None:
+                misses.append(i)
+                continue
+            resolve(i, {
+                "food": f["food"],
+                "grams": f["grams"],
+                "nutrients": scale_nutrients(per100, float(f["grams"]) / 100),
+            })
+
+        if misses:
+            # 成分表にもキャッシュにもない食品は、他のセッションの分とまとめて AI に問い合わせる
+            # 同じ食品・グラム数の行は同じ Future を共有するので、Future ごとに行の一覧を持つ
+            futures = {}
+            for i in misses:
+                fut = self.food_batcher.submit(
+                    (normalize_food_name(food_list[i]["food"]), float(food_list[i]["grams"])), food_list[i]
+                )
+                futures.setdefault(fut, []).append(i)
+            new_entries = []
+            try:
+                for fut in as_completed(futures):
+                    # 途中で接続が切れても、それまでに確定した食品は on_item 済みなので全体は失敗にしない
+                    # （残りは failed として返す）
+                    try:
+                        found = fut.result()
+                    except Exception:
+                        continue
+                    if found is None:
+                        continue
+                    for n, i in enumerate(futures[fut]):
+                        item = {"food": food_list[i]["food"], "grams": food_list[i]["grams"], "nutrients": found["nutrients"]}
+                        resolve(i, item)
+                        grams = float(food_list[i]["grams"])
+                        if n == 0 and grams > 0 and item["nutrients"] and found.get("cacheable", True):
+                            new_entries.append((
+                                keys[i], normalize_food_name(food_list[i]["food"]),
+                                self.model, NUTRITION_PROMPT_VERSION,
+                                scale_nutrients(item["nutrients"], 100 / grams),
+                            ))
+            finally:
+                put_cached_nutrients(new_entries)
+
+        failed = [f["food"] for f, item in zip(food_list, items) if item is None]
+        items = [item for item in items if item is not None]
+        return {"items": items, "total": sum_nutrients(items), "failed": failed}
+
+    @staticmethod
+    def _match_item(food_list, batch, pending, position, item):
+        """AI の返した item を問い合わせた食品に対応付ける（食品名とグラム数→返ってきた順番の順で照合）
+
+        別のユーザーの分とまとめて問い合わせるので、同じ食品名でもグラム数が違う行がありうる。
+        """
+        key = (normalize_food_name(item.food), float(item.grams))
+        for i in batch:
+            if i in pending and (normalize_food_name(food_list[i]["food"]), float(food_list[i]["grams"])) == key:
+                return i
+        if position < len(batch) and batch[position] in pending:
+            return batch[position]
+        return None
+
+    def _analyze_batch(self, batch, resolve):
+        """food_batcher のハンドラ。まとめた食品を1回のプロンプトで解析し、item が閉じるたびに返す"""
+        foods = [food for _, food in batch]
+        for i, item in self._stream_food_multi(foods, range(len(foods))):
+            resolve(batch[i][0], item)
+
+    def _stream_food_multi(self, food_list, indexes, attempts=2):
+        """indexes の食品を AI に問い合わせ、(index, item) を item が閉じるたびに返す
+
+        スキーマに合わない item や返ってこなかった食品は、残りだけもう一度問い合わせる。
+        """
+        pending = list(indexes)
+        for _ in range(attempts):
+            if not pending:
+                return
+            batch = list(pending)
+            parser = JsonItemStream()
+            position = 0
+            prompt = self._food_multi_prompt([food_list[i] for i in batch])
+            stream = self.generate_content_stream(
+                prompt, label="analyze_food_multi", config=FOOD_ANALYSIS_CONFIG, priority=PRIORITY_MEAL
+            )
+            for chunk in stream:
+                for obj in parser.feed(chunk):
+                    position += 1
+                    try:
+                        item = FoodItem.model_validate(obj)
+                    except ValidationError:
+                        continue
+                    i = self._match_item(food_list, batch, pending, position - 1, item)
+                    if i is None:
+                        continue
+                    pending.remove(i)
+                    yield i, {
+                        "food": food_list[i]["food"],
+                        "grams": food_list[i]["grams"],
+                        "nutrients": [n.model_dump() for n in item.nutrients],
+                        # 返ってきたグラム数が問い合わせと違う（順番で対応付けた）ものはキャッシュしない
+                        "cacheable": float(item.grams) == float(food_list[i]["grams"]),
+                    }
+
+    @staticmethod
+    def _food_multi_prompt(food_list):
 
         foods_text = "\n".join(
             f"- {f['food']} {f['grams']}g" for f in food_list
         )
 
-        prompt = f"""
+        return f"""
         あなたは栄養士です。
         次の食品の栄養素（カロリー, たんぱく質, 脂質, 炭水化物, 食物繊維, 糖質, 塩分）を推定し、
-        食品ごとの栄養素リストと合計を返してください。
+        食品ごとの栄養素リストを返してください。
 
         食品:
         {foods_text}
 
-        出力は JSON のみ。形式は必ず以下に従う:
+        items は上の食品と同じ順番・同じ食品名で返す。
+        nutrients の name と unit は次のとおり:
+        カロリー(kcal), たんぱく質(g), 炭水化物(g), 脂質(g), 食物繊維(g), 糖質(g), 塩分(g)
 
-        {{
-        "items":[
-        {{
-            "food":"食品名",
-            "grams":数値,
-            "nutrients":[
-            {{"name":"カロリー","value":数値,"unit":"kcal"}},
-            {{"name":"たんぱく質","value":数値,"unit":"g"}},
-            {{"name":"炭水化物","value":数値,"unit":"g"}},
-            {{"name":"脂質","value":数値,"unit":"g"}},
-            {{"name":"食物繊維","value":数値,"unit":"g"}},
-            {{"name":"糖質","value":数値,"unit":"g"}},
-            {{"name":"塩分","value":数値,"unit":"g"}}
-            ]
-        }}
-        ],
-        "total":[ ... ]
-        }}
-
-        ユーザー情報：
-        {ui}
-
-        アドバイスは不要。JSON のみ返す。
+        アドバイスは不要。
         """
 
-        chat = client.chats.create(model=self.model)
-        res = chat.send_message(prompt)
-        reply = res.text.strip()
-        # JSON Extraction
-        m = re.search(r"\{[\s\S]*\}", reply)
-        if m:
-            try:
-                return json.loads(m.group(0))
-            except:
-                pass
-        return {"items": [], "total": []}
-
 
 
 
@@ -282,10 +754,137 @@ def calc_nutrient_targets(profile):
         "塩分": 6.5
     }
 
+# -----------------------------
+# ローカルの代替プロバイダ（通信なし・毎回同じ結果）
+#   GeminiModel のクライアントだけを FakeClient に替えたもの。バッチ・キャッシュ・スケジューラ・
+#   ストリームの解析は本番と同じ経路を通るので、負荷試験やベンチマークをオフラインで再現できる
+#   栄養素は 成分表 → フィクスチャ(JSON) → 食品名のハッシュから決めた値 の順で返す
+# -----------------------------
+_FOOD_LINE = re.compile(r"^\s*- (.+) ([\d.]+)g\s*$", re.MULTILINE)
+_SINGLE_FOOD = re.compile(r"食品「(.+?)」の、\*\*([\d.]+)gあたり")
+
+
+class LocalModel(GeminiModel):
+    name = "local"
+
+    def __init__(self, latency=0.0, fixtures_path=None, chunk_size=20, scheduler=None):
+        """latency: 1回の呼び出しで応答が届き始めるまでの待ち時間（秒）"""
+        self.fixtures = {}
+        if fixtures_path:
+            # {"食品名": {"カロリー": 100gあたりの値, ...}, ...}
+            with open(fixtures_path, encoding="utf-8") as f:
+                self.fixtures = {normalize_food_name(k): v for k, v in json.load(f).items()}
+        # model はキャッシュのキーに入るので、本物の AI の結果と混ざらない名前にする
+        client = FakeClient(self._respond, latency=latency, chunk_size=chunk_size)
+        super().__init__(model="local", client=client, scheduler=scheduler)
+
+    def _per100(self, food):
+        per100 = self.fixtures.get(normalize_food_name(food))
+        if per100 is None:
+            h = hashlib.sha256(normalize_food_name(food).encode("utf-8")).digest()
+            per100 = {
+                "カロリー": 50 + h[0] % 350,
+                "たんぱく質": h[1] % 250 / 10,
+                "炭水化物": h[2] % 600 / 10,
+                "脂質": h[3] % 300 / 10,
+                "食物繊維": h[4] % 50 / 10,
+                "塩分": h[5] % 30 / 10,
+            }
+            per100["糖質"] = max(per100["炭水化物"] - per100["食物繊維"], 0)
+        return [
+            {"name": name, "value": per100.get(name, 0), "unit": "kcal" if name == "カロリー" else "g"}
+            for name in ["カロリー", "たんぱく質", "炭水化物", "脂質", "食物繊維", "糖質", "塩分"]
+        ]
+
+    def _nutrients(self, food, grams):
+        nutrients = lookup_nutrients(food, grams)
+        if nutrients is None:
+            nutrients = scale_nutrients(self._per100(food), grams / 100)
+        return nutrients
+
+    def _respond(self, prompt):
+        """FakeClient の responder。プロンプトの種類を見分けて、AI と同じ形の応答を作る"""
+        if "献立案" in prompt:
+            return self._menu_text(
+                self._json_after(prompt, "--- 今日の摂取栄養素合計 ---"),
+                self._json_after(prompt, "--- 栄養目標値 ---"),
+            )
+        if "食品ごとの栄養素リスト" in prompt:
+            items = [
+                {"food": food, "grams": float(grams), "nutrients": self._nutrients(food, float(grams))}
+                for food, grams in _FOOD_LINE.findall(prompt)
+            ]
+            return json.dumps({"items": items}, ensure_ascii=False)
+        if "栄養目標値" in prompt:
+            return self._advice_text(
+                self._json_after(prompt, "栄養素の合計:"),
+                self._json_after(prompt, "栄養目標値:"),
+            )
+        m = _SINGLE_FOOD.search(prompt)
+        if m:
+            return json.dumps(
+                {"nutrients": self._nutrients(m.group(1), float(m.group(2))), "advice": "バランスよく食べましょう。"},
+                ensure_ascii=False,
+            )
+        if '"is_food"' in prompt:
+            return '{"is_food": true}'
+        raise ValueError("LocalModel が知らないプロンプトです")
+
+    @staticmethod
+    def _json_after(prompt, marker):
+        """prompt の最後の marker の後にある JSON オブジェクト"""
+        start = prompt.index("{", prompt.rindex(marker))
+        return json.JSONDecoder().raw_decode(prompt, start)[0]
+
+    @staticmethod
+    def _balance_lines(nutri_total, nutrient_targets):
+        lines = []
+        for name, target in nutrient_targets.items():
+            value = nutri_total.get(name, 0)
+            ratio = value / target if target else 0
+            state = "不足" if ratio < 0.8 else "過剰" if ratio > 1.2 else "適量"
+            lines.append((name, value, target, state))
+        return lines
+
+    def _advice_text(self, nutri_total, nutrient_targets):
+        lines = self._balance_lines(nutri_total, nutrient_targets)
+        good = [n for n, _, _, state in lines if state == "適量"]
+        bad = [f"{n}が{state}（{v:g} / {t}）" for n, v, t, state in lines if state != "適量"]
+        return (
+            "1. 良かった点: " + ("、".join(good) + "が目標に近い量でした。" if good else "記録を続けられました。") + "\n"
+            "2. 改善ポイント: " + ("、".join(bad) + "。" if bad else "特にありません。") + "\n"
+            "3. 明日の行動アドバイス: 不足している栄養素を1品ずつ補いましょう。"
+        )
+
+    def _menu_text(self, nutri_total, nutrient_targets):
+        lines = self._balance_lines(nutri_total, nutrient_targets)
+        short = [n for n, _, _, state in lines if state == "不足"] or ["バランス"]
+        return (
+            "朝食:\n● ごはんと納豆\n    - 材料:\n        ・ごはん：150g\n        ・納豆：1パック\n"
+            "昼食:\n● 鶏むね肉のソテー\n    - 材料:\n        ・鶏むね肉：120g\n        ・ブロッコリー：60g\n"
+            "夕食:\n● 焼き魚と味噌汁\n    - 材料:\n        ・鮭：1切れ\n        ・豆腐：50g\n"
+            f"    - 理由: {'・'.join(short)}を補うため"
+        )
+
+
 # -----------------------------
 # インスタンス化
+#   LLM_PROVIDER=local で通信しない代替プロバイダに切り替える
+#   （LOCAL_LLM_LATENCY_MS: 呼び出しごとの待ち時間, LOCAL_LLM_FIXTURES: 栄養素の JSON）
 # -----------------------------
-gemini_model = GeminiModel()
+def create_llm(provider=None) -> LLMProvider:
+    provider = provider or os.getenv("LLM_PROVIDER", "gemini")
+    if provider == "gemini":
+        return GeminiModel()
+    if provider == "local":
+        return LocalModel(
+            latency=float(os.getenv("LOCAL_LLM_LATENCY_MS", "0")) / 1000,
+            fixtures_path=os.getenv("LOCAL_LLM_FIXTURES") or None,
+        )
+    raise ValueError(f"unknown LLM_PROVIDER: {provider}")
+
+
+llm = create_llm()
 
 def load_css(file_name: str):
     with open(file_name, "r", encoding="utf-8") as f: